@@ -65,6 +65,7 @@ class Driver(InstrumentDriver.InstrumentWorker):
                 Quantity.ControlSetpointX,
                 Quantity.ControlSetpointY,
                 Quantity.ControlSetpointZ,
+                Quantity.ControlSetpointList,
                 Quantity.ControlHoldCurrent,
                 Quantity.ControlHoldSwitchheaterOn,
             ):
@@ -77,7 +78,7 @@ class Driver(InstrumentDriver.InstrumentWorker):
                         logger.info(
                             f"********** FINAL CALL {quant.name} {value}: {options}"
                         )
-                        self._thread.wait_till_ramped_sync()
+                        self._thread.wait_till_ramped_sync(is_stopped=self.isStopped)
                         logger.info(
                             f"********** FINAL CALL DONE {quant.name} {value}: {options}"
                         )
@@ -106,9 +107,17 @@ class Driver(InstrumentDriver.InstrumentWorker):
             raise Exception("performGetValue(): Unknown quant.name={quant.name} ")
 
         try:
-            value = self._thread.get_quantity_sync(quantity=quantity)
+            if self.isFirstCall(options):
+                # One snapshot answers all the status quantities of this call group
+                self._thread.begin_get_group_sync()
+            value = self._thread.get_value(name=quantity.value)
+            if quant.datatype == quant.VECTOR:
+                return quant.getTraceDict(value, x0=0.0, dx=1.0)
             return value
         except:
             raise Exception(
-                f"performGetValue(): Failed to get_quantity_sync(quantity={quantity}) "
+                f"performGetValue(): Failed to get_value(quantity={quantity}) "
             )
+        finally:
+            if self.isFinalCall(options):
+                self._thread.end_get_group()
@@ -80,14 +80,18 @@ class Quantity(EnumMixin, enum.Enum):
     ControlLogging = "Control / Logging"
     ControlLabberState = "Control / Labber State"
     ControlMode = "Control / Mode"
+    ControlRampMode = "Control / Ramp Mode"
+    ControlStatusMaxAge = "Control / Status Max Age"
     ControlHoldCurrent = "Control / Hold Current Z"
     ControlHoldSwitchheaterOn = "Control / Hold Switchheater on Z"
+    ControlSwitchheaterCoolDelay = "Control / Switchheater Cool Delay Z"
     ControlRampRateZ = "Control / Ramp Rate Z"
     ControlRampRateX = "Control / Ramp Rate X"
     ControlRampRateY = "Control / Ramp Rate Y"
     ControlSetpointX = "Control / Field Setpoint X"
     ControlSetpointY = "Control / Field Setpoint Y"
     ControlSetpointZ = "Control / Field Setpoint Z"
+    ControlSetpointList = "Control / Setpoint List"
     StatusSwitchheaterStatus = "Status / Switchheater Status Z"
     StatusFieldActualX = "Status / Field actual X"
     StatusFieldActualY = "Status / Field actual Y"
@@ -95,5 +99,21 @@ class Quantity(EnumMixin, enum.Enum):
     StatusMagnetStateX = "Status / Magnet State X"
     StatusMagnetStateY = "Status / Magnet State Y"
     StatusMagnetStateZ = "Status / Magnet State Z"
+    StatusVisaLatencyP50X = "Status / VISA Latency p50 X"
+    StatusVisaLatencyP50Y = "Status / VISA Latency p50 Y"
+    StatusVisaLatencyP50Z = "Status / VISA Latency p50 Z"
+    StatusVisaLatencyP99X = "Status / VISA Latency p99 X"
+    StatusVisaLatencyP99Y = "Status / VISA Latency p99 Y"
+    StatusVisaLatencyP99Z = "Status / VISA Latency p99 Z"
+    StatusVisaCalls = "Status / VISA Calls"
+    StatusSnapshotAge = "Status / Snapshot Age"
+    StatusAbortLatency = "Status / Abort Latency"
+    StatusWorkerRestarts = "Status / Worker Restarts"
+    StatusPlannedRampTime = "Status / Planned Ramp Time"
+    StatusRampEta = "Status / Ramp ETA"
+    StatusRampProgress = "Status / Ramp progress"
+    StatusSetpointListIndex = "Status / Setpoint List Index"
+    StatusSetpointListArrivals = "Status / Setpoint List Arrivals"
+    StatusSwitchheaterTimeSaved = "Status / Switchheater Time Saved Z"
     ConfigName = "Config / Name"
     ConfigAxis = "Config / Axis"
@@ -0,0 +1,91 @@
+"""
+History of the completed magnet ramps and the durations predicted from it.
+
+File format: One JSON object per line, append only, see 'RampRecord'.
+"""
+
+import json
+import logging
+import pathlib
+import statistics
+import collections
+import dataclasses
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger("LabberDriver")
+
+RECORDS_PER_MAGNET = 20
+"Only the most recent ramps of every magnet are used for the prediction"
+
+
+@dataclass(frozen=True)
+class RampRecord:
+    magnet: str
+    time_s: float
+    "When the ramp was completed"
+    from_T: float
+    to_T: float
+    rate_Tpers: float
+    phases_s: Dict[str, float]
+    "'MagnetRampingState' name -> time spent in this state"
+    switchheater_switches: int
+    "Number of 'PS 1' and 'PS 0' commands"
+
+    @property
+    def distance_T(self) -> float:
+        return abs(self.to_T - self.from_T)
+
+
+class RampHistory:
+    def __init__(self, filename: Optional[pathlib.Path]):
+        self.filename = None if filename is None else pathlib.Path(filename)
+        self._records: Dict[str, Deque[RampRecord]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=RECORDS_PER_MAGNET)
+        )
+        if self.filename is not None and self.filename.exists():
+            self._load()
+
+    def _load(self) -> None:
+        with self.filename.open("r", encoding="ascii") as f:
+            for line in f:
+                try:
+                    record = RampRecord(**json.loads(line))
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"'{self.filename}': Skipped '{line.strip()}': {e}")
+                    continue
+                self._records[record.magnet].append(record)
+
+    def append(self, record: RampRecord) -> None:
+        self._records[record.magnet].append(record)
+        if self.filename is None:
+            return
+        with self.filename.open("a", encoding="ascii") as f:
+            f.write(json.dumps(dataclasses.asdict(record)) + "\n")
+
+    def phase_s(self, magnet: str, phase: str) -> Optional[float]:
+        """
+        The median time spent in 'phase'. None if never observed.
+        """
+        durations_s = [
+            record.phases_s[phase]
+            for record in self._records[magnet]
+            if phase in record.phases_s
+        ]
+        if len(durations_s) == 0:
+            return None
+        return statistics.median(durations_s)
+
+    def ramp_overhead_s(self, magnet: str, phase: str) -> float:
+        """
+        The median time the field ramp 'phase' took longer than 'distance/rate':
+        Supply acceleration, polling latency...
+        """
+        overheads_s = [
+            record.phases_s[phase] - record.distance_T / record.rate_Tpers
+            for record in self._records[magnet]
+            if phase in record.phases_s and record.rate_Tpers > 0.0
+        ]
+        if len(overheads_s) == 0:
+            return 0.0
+        return statistics.median(overheads_s)
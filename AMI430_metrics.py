@@ -0,0 +1,134 @@
+"""
+Latency histograms and call counters of the VISA communication.
+"""
+
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+_BUCKETS_PER_DECADE = 10
+BUCKET_UPPER_BOUNDS_S: Tuple[float, ...] = tuple(
+    10.0 ** (exponent / _BUCKETS_PER_DECADE)
+    for exponent in range(-4 * _BUCKETS_PER_DECADE, 2 * _BUCKETS_PER_DECADE + 1)
+)
+"Log spaced from 100us to 100s. The last bucket collects everything above."
+
+
+def command_verb(cmd: str) -> str:
+    """
+    'CONF:FIELD:TARG 0.100000' -> 'CONF:FIELD:TARG'
+    'FIELD:MAG?' -> 'FIELD:MAG?'
+    """
+    return cmd.split(" ", 1)[0]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKET_UPPER_BOUNDS_S) + 1)
+        self.count = 0
+        self.sum_s = 0.0
+        self.max_s = 0.0
+
+    def record(self, duration_s: float) -> None:
+        self.counts[bisect.bisect_left(BUCKET_UPPER_BOUNDS_S, duration_s)] += 1
+        self.count += 1
+        self.sum_s += duration_s
+        self.max_s = max(self.max_s, duration_s)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum_s += other.sum_s
+        self.max_s = max(self.max_s, other.max_s)
+
+    def percentile_s(self, percent: float) -> float:
+        """
+        Upper bound of the bucket containing the percentile.
+        Returns 0.0 if nothing was recorded.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100.0 * self.count
+        cumulated = 0
+        for i, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= rank and count > 0:
+                if i == len(BUCKET_UPPER_BOUNDS_S):
+                    return self.max_s
+                return min(BUCKET_UPPER_BOUNDS_S[i], self.max_s)
+        return self.max_s
+
+    @property
+    def mean_s(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.sum_s / self.count
+
+    def text(self) -> str:
+        return (
+            f"n={self.count} p50={1000.0*self.percentile_s(50.0):0.1f}ms "
+            f"p99={1000.0*self.percentile_s(99.0):0.1f}ms max={1000.0*self.max_s:0.1f}ms"
+        )
+
+
+class VisaMetrics:
+    """
+    Latency histograms per axis and command verb.
+
+    'total' accumulates since the driver was opened.
+    'interval' is reset by every 'summary()'.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._total: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._interval: Dict[Tuple[str, str], LatencyHistogram] = {}
+
+    def record(self, axis: str, verb: str, duration_s: float) -> None:
+        key = (axis, verb)
+        with self._lock:
+            for histograms in (self._total, self._interval):
+                histogram = histograms.get(key, None)
+                if histogram is None:
+                    histogram = histograms[key] = LatencyHistogram()
+                histogram.record(duration_s)
+
+    @staticmethod
+    def _merge(
+        histograms: Dict[Tuple[str, str], LatencyHistogram],
+        axis: Optional[str],
+        verb: Optional[str],
+    ) -> LatencyHistogram:
+        merged = LatencyHistogram()
+        for (_axis, _verb), histogram in histograms.items():
+            if axis is not None and axis != _axis:
+                continue
+            if verb is not None and verb != _verb:
+                continue
+            merged.merge(histogram)
+        return merged
+
+    def histogram(
+        self, axis: Optional[str] = None, verb: Optional[str] = None
+    ) -> LatencyHistogram:
+        with self._lock:
+            return self._merge(self._total, axis=axis, verb=verb)
+
+    def summary(self) -> str:
+        """
+        One line per call: Every axis and its slowest verb since the last summary.
+        """
+        with self._lock:
+            interval, self._interval = self._interval, {}
+        texts = []
+        for axis in sorted({_axis for _axis, _verb in interval}):
+            histogram = self._merge(interval, axis=axis, verb=None)
+            verb_slowest = max(
+                (_verb for _axis, _verb in interval if _axis == axis),
+                key=lambda _verb: interval[(axis, _verb)].percentile_s(99.0),
+            )
+            texts.append(
+                f"{axis}: {histogram.text()} slowest '{verb_slowest}' {interval[(axis, verb_slowest)].text()}"
+            )
+        return "; ".join(texts)
@@ -0,0 +1,194 @@
+"""
+Plan the path of a field change which stays within the field limit of the station.
+
+Candidates:
+ - All magnets at once on a straight line (as RampMode.VECTOR).
+ - One magnet after the other: Every order of the magnets to be ramped.
+ - Two straight lines via a waypoint: Some magnets are ramped to zero first.
+
+Every candidate path is sampled and checked by 'is_field_allowed'.
+The fastest safe candidate is chosen. The duration only covers the field ramps:
+Switch heater delays are the same for all candidates.
+"""
+
+import math
+import itertools
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from AMI430_utils import FieldLimitViolation
+
+PATH_SAMPLES = 101
+"Intermediate fields per straight line to be checked against the field limit"
+
+_FIELD_EQUAL_T = 1e-12
+
+Field = Dict[str, float]
+"Magnet name -> field in Tesla"
+
+
+def find_line_violation(
+    start_T: Field,
+    target_T: Field,
+    is_field_allowed: Callable[[Field], bool],
+    samples: int = PATH_SAMPLES,
+) -> Optional[Field]:
+    """
+    Returns the first field on the straight line violating the limit, None if all are allowed.
+    """
+    for i in range(samples):
+        field_T = {
+            name: start_T[name] + (target_T[name] - start_T[name]) * i / (samples - 1)
+            for name in target_T
+        }
+        if not is_field_allowed(field_T):
+            return field_T
+    return None
+
+
+def _ramp_duration_s(distance_T: float, rate_Tpers: float) -> float:
+    if abs(distance_T) < _FIELD_EQUAL_T:
+        return 0.0
+    if rate_Tpers <= 0.0:
+        return math.inf
+    return abs(distance_T) / rate_Tpers
+
+
+@dataclass(frozen=True)
+class Leg:
+    """
+    Ramp from the end of the previous leg to 'target_T'.
+    """
+
+    target_T: Field
+    order: Tuple[str, ...]
+    "The magnets are ramped one after the other. Empty: All magnets at once on a straight line."
+    duration_s: float
+
+    @property
+    def vector(self) -> bool:
+        return len(self.order) == 0
+
+    @property
+    def text(self) -> str:
+        target = ",".join(
+            f"{name}={self.target_T[name]:0.3f}" for name in sorted(self.target_T)
+        )
+        order = "vector" if self.vector else "->".join(self.order)
+        return f"{order}({target}) {self.duration_s:0.1f}s"
+
+
+@dataclass(frozen=True)
+class Plan:
+    legs: Tuple[Leg, ...]
+
+    @property
+    def duration_s(self) -> float:
+        return sum(leg.duration_s for leg in self.legs)
+
+    @property
+    def text(self) -> str:
+        return f"{self.duration_s:0.1f}s: " + ", ".join(leg.text for leg in self.legs)
+
+
+def _vector_leg(start_T: Field, target_T: Field, rate_Tpers: Field) -> Leg:
+    duration_s = max(
+        _ramp_duration_s(target_T[name] - start_T[name], rate_Tpers[name])
+        for name in target_T
+    )
+    return Leg(target_T=dict(target_T), order=(), duration_s=duration_s)
+
+
+def _sequential_leg(
+    start_T: Field, target_T: Field, rate_Tpers: Field, order: Sequence[str]
+) -> Leg:
+    duration_s = sum(
+        _ramp_duration_s(target_T[name] - start_T[name], rate_Tpers[name])
+        for name in order
+    )
+    return Leg(target_T=dict(target_T), order=tuple(order), duration_s=duration_s)
+
+
+def _corners(start_T: Field, leg: Leg) -> List[Field]:
+    "The fields the leg passes: Connected by straight lines."
+    if leg.vector:
+        return [start_T, leg.target_T]
+    corners = [start_T]
+    field_T = dict(start_T)
+    for name in leg.order:
+        field_T[name] = leg.target_T[name]
+        corners.append(dict(field_T))
+    return corners
+
+
+def is_plan_safe(
+    start_T: Field, plan: Plan, is_field_allowed: Callable[[Field], bool]
+) -> bool:
+    for leg in plan.legs:
+        corners = _corners(start_T, leg)
+        for begin_T, end_T in zip(corners[:-1], corners[1:]):
+            if find_line_violation(begin_T, end_T, is_field_allowed) is not None:
+                return False
+        start_T = leg.target_T
+    return True
+
+
+def candidate_plans(start_T: Field, target_T: Field, rate_Tpers: Field) -> List[Plan]:
+    """
+    Ordered by preference if the duration is the same.
+    Without a ramp rate for every magnet, the rates of a straight line can not be
+    scaled: Only the sequential candidates.
+    """
+    moving = [
+        name
+        for name in sorted(target_T)
+        if abs(target_T[name] - start_T[name]) >= _FIELD_EQUAL_T
+    ]
+    plans = []
+    vector_possible = all(rate > 0.0 for rate in rate_Tpers.values())
+    if vector_possible:
+        plans.append(Plan(legs=(_vector_leg(start_T, target_T, rate_Tpers),)))
+    for order in itertools.permutations(moving):
+        plans.append(
+            Plan(legs=(_sequential_leg(start_T, target_T, rate_Tpers, order),))
+        )
+    if not vector_possible:
+        return plans
+    nonzero = [name for name in sorted(start_T) if abs(start_T[name]) >= _FIELD_EQUAL_T]
+    for count in range(1, len(nonzero) + 1):
+        for zeroed in itertools.combinations(nonzero, count):
+            waypoint_T = {
+                name: 0.0 if name in zeroed else start_T[name] for name in start_T
+            }
+            plans.append(
+                Plan(
+                    legs=(
+                        _vector_leg(start_T, waypoint_T, rate_Tpers),
+                        _vector_leg(waypoint_T, target_T, rate_Tpers),
+                    )
+                )
+            )
+    return plans
+
+
+def plan_path(
+    start_T: Field,
+    target_T: Field,
+    rate_Tpers: Field,
+    is_field_allowed: Callable[[Field], bool],
+) -> Plan:
+    """
+    Returns the fastest safe plan.
+    Raises FieldLimitViolation if no candidate stays within the field limit.
+    """
+    plans = [
+        plan
+        for plan in candidate_plans(start_T, target_T, rate_Tpers)
+        if is_plan_safe(start_T, plan, is_field_allowed)
+    ]
+    if len(plans) == 0:
+        raise FieldLimitViolation(
+            f"No path from {start_T} to {target_T} within the field limit"
+        )
+    # 'min' returns the first of equally fast plans
+    return min(plans, key=lambda plan: plan.duration_s)
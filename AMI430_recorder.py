@@ -0,0 +1,179 @@
+"""
+Record the SCPI traffic of all magnets and replay it without supplies attached.
+
+File format: One line per command, tab separated, append only:
+  <time_s> <duration_s> <axis> W <command>
+  <time_s> <duration_s> <axis> Q <query> <response>
+The queries of a pipelined exchange share one line each, the duration of
+the exchange is stored on the first line.
+
+Replay answers every query with the response recorded last before the
+replay clock. The replay clock runs 'time_compression' times faster than
+the wall clock, starting at the first recorded line.
+This is robust against a different polling rate during replay.
+Every command is delayed by the duration recorded on the same line, also compressed:
+A pipelined exchange takes as long as recorded.
+"""
+
+import bisect
+import logging
+import pathlib
+import threading
+import time
+import collections
+from typing import Deque, Dict, List, Sequence, Tuple
+
+import pyvisa
+import pyvisa.constants
+
+from AMI430_metrics import command_verb
+
+logger = logging.getLogger("LabberDriver")
+
+_KIND_WRITE = "W"
+_KIND_QUERY = "Q"
+_RESPONSE_NOT_RECORDED = "ERROR"
+
+
+class ScpiRecorder:
+    def __init__(self, filename: pathlib.Path):
+        self.filename = pathlib.Path(filename)
+        self._lock = threading.Lock()
+        self._f = self.filename.open("a", encoding="ascii")
+        logger.info(f"Recording SCPI traffic to '{self.filename}'")
+
+    def _append(self, line: str) -> None:
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+
+    def write(self, axis: str, cmd: str, duration_s: float) -> None:
+        self._append(
+            f"{time.time():0.3f}\t{duration_s:0.4f}\t{axis}\t{_KIND_WRITE}\t{cmd}\n"
+        )
+
+    def queries(
+        self,
+        axis: str,
+        cmds: Sequence[str],
+        responses: Sequence[str],
+        duration_s: float,
+    ) -> None:
+        time_s = time.time()
+        durations_s = [duration_s] + [0.0] * (len(cmds) - 1)
+        self._append(
+            "".join(
+                f"{time_s:0.3f}\t{_duration_s:0.4f}\t{axis}\t{_KIND_QUERY}\t{cmd}\t{response}\n"
+                for cmd, response, _duration_s in zip(cmds, responses, durations_s)
+            )
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+
+
+class ScpiReplaySession:
+    """
+    A recorded session, shared by the replay resources of all axes.
+    """
+
+    def __init__(self, filename: pathlib.Path, time_compression: float = 1.0):
+        assert time_compression > 0.0
+        self.filename = pathlib.Path(filename)
+        self.time_compression = time_compression
+        self._lines: Dict[
+            Tuple[str, str], Tuple[List[float], List[str], List[float]]
+        ] = {}
+        "(axis, command) -> times, responses and durations as recorded"
+        self._durations_s: Dict[Tuple[str, str], float] = {}
+        "Last recorded duration of every command (without arguments) of every axis"
+        self._recorded_start_s = None
+        with self.filename.open("r", encoding="ascii") as f:
+            for line in f:
+                self._parse(line.rstrip("\n"))
+        if self._recorded_start_s is None:
+            raise ValueError(f"'{self.filename}': No SCPI traffic recorded!")
+        self._replay_start_s = time.time()
+
+    def _parse(self, line: str) -> None:
+        fields = line.split("\t", 5)
+        if len(fields) < 5:
+            return
+        time_s = float(fields[0])
+        if self._recorded_start_s is None:
+            self._recorded_start_s = time_s
+        axis, kind, cmd = fields[2], fields[3], fields[4]
+        duration_s = float(fields[1])
+        if duration_s > 0.0:
+            # Not the second line of a pipelined exchange
+            self._durations_s[(axis, command_verb(cmd))] = duration_s
+        response = fields[5] if kind == _KIND_QUERY else ""
+        times_s, responses, durations_s = self._lines.setdefault(
+            (axis, cmd), ([], [], [])
+        )
+        times_s.append(time_s)
+        responses.append(response)
+        durations_s.append(duration_s)
+
+    @property
+    def replay_time_s(self) -> float:
+        "The recorded time which corresponds to now."
+        elapsed_s = time.time() - self._replay_start_s
+        return self._recorded_start_s + elapsed_s * self.time_compression
+
+    def exchange(self, axis: str, cmd: str) -> str:
+        """
+        Waits the recorded duration and returns the recorded response.
+        """
+        try:
+            times_s, responses, durations_s = self._lines[(axis, cmd)]
+        except KeyError:
+            # Not recorded, for example different arguments
+            logger.debug(f"{axis}: '{cmd}' not recorded in '{self.filename}'")
+            self._sleep(self._durations_s.get((axis, command_verb(cmd)), 0.0))
+            # Answer like the pyvisa-sim instrument does
+            return _RESPONSE_NOT_RECORDED
+        i = max(bisect.bisect_right(times_s, self.replay_time_s) - 1, 0)
+        self._sleep(durations_s[i])
+        return responses[i]
+
+    def _sleep(self, duration_s: float) -> None:
+        if duration_s > 0.0:
+            time.sleep(duration_s / self.time_compression)
+
+
+class ScpiReplayResource:
+    """
+    Drop in for the pyvisa resource of one magnet: Answers from a 'ScpiReplaySession'.
+    Writes are accepted and ignored.
+    """
+
+    def __init__(self, session: ScpiReplaySession, axis: str):
+        self._session = session
+        self._axis = axis
+        self._output: Deque[str] = collections.deque()
+        self.timeout = 2000.0
+        self.write_termination = "\n"
+        self.read_termination = "\n"
+
+    def write(self, cmd: str) -> None:
+        response = self._session.exchange(self._axis, cmd)
+        if cmd.endswith("?"):
+            self._output.append(response)
+
+    def read(self) -> str:
+        try:
+            return self._output.popleft()
+        except IndexError as e:
+            raise pyvisa.VisaIOError(pyvisa.constants.StatusCode.error_timeout) from e
+
+    def query(self, cmd: str) -> str:
+        self.write(cmd)
+        return self.read()
+
+    def clear(self) -> None:
+        self._output.clear()
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,226 @@
+"""
+Native asyncio transport for AMI430 'TCPIP0::<host>::7180::SOCKET' resources.
+
+'AMI430SocketResource' implements the subset of 'pyvisa.resources.MessageBasedResource'
+used by 'VisaMagnet' (write/read/query/clear/close) so 'write_raw' and 'ask_raw'
+keep their semantics. Additionally it supports pipelined queries and per request timeouts.
+
+All sockets share one event loop running in a daemon thread.
+Received bytes are read into a reusable buffer ('asyncio.BufferedProtocol').
+"""
+
+import re
+import asyncio
+import logging
+import threading
+import collections
+from typing import Deque, List, Optional, Sequence, Tuple
+
+import pyvisa
+import pyvisa.constants
+
+logger = logging.getLogger("LabberDriver")
+
+_RE_SOCKET_ADDRESS = re.compile(
+    r"^TCPIP\d*::(?P<host>[^:]+)::(?P<port>\d+)::SOCKET$", re.IGNORECASE
+)
+
+_BUFFER_SIZE = 4096
+_TERMINATOR = ord("\n")
+_CARRIAGE_RETURN = ord("\r")
+
+
+def parse_socket_address(address: str) -> Optional[Tuple[str, int]]:
+    """
+    'TCPIP0::169.254.27.8::7180::SOCKET' -> ('169.254.27.8', 7180)
+    Returns None for all other resources (GPIB, INSTR, ...).
+    """
+    match = _RE_SOCKET_ADDRESS.match(address)
+    if match is None:
+        return None
+    return match.group("host"), int(match.group("port"))
+
+
+class _EventLoopThread(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name="AMI430_socket")
+        self.loop = asyncio.new_event_loop()
+        self.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+_EVENT_LOOP_THREAD: Optional[_EventLoopThread] = None
+_EVENT_LOOP_THREAD_LOCK = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _EVENT_LOOP_THREAD  # pylint: disable=global-statement
+    with _EVENT_LOOP_THREAD_LOCK:
+        if _EVENT_LOOP_THREAD is None:
+            _EVENT_LOOP_THREAD = _EventLoopThread()
+        return _EVENT_LOOP_THREAD.loop
+
+
+class _LineProtocol(asyncio.BufferedProtocol):
+    """
+    Splits the received bytes into lines.
+    The receive buffer is allocated once and reused for every response.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray(_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+        self._lines: Deque[str] = collections.deque()
+        self._waiter: Optional[asyncio.Future] = None
+        self.transport: Optional[asyncio.Transport] = None
+        self.exception: Optional[Exception] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.exception = exc or ConnectionResetError("Connection closed by peer")
+        self._wakeup()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._end == len(self._buffer):
+            # A line longer than the buffer: Grow (should never happen with the AMI430)
+            buffer = bytearray(2 * len(self._buffer))
+            buffer[: self._end] = self._view[: self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        return self._view[self._end :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        search_from = self._end
+        self._end += nbytes
+        begin = 0
+        while True:
+            pos = self._buffer.find(_TERMINATOR, search_from, self._end)
+            if pos < 0:
+                break
+            end = pos
+            if end > begin and self._buffer[end - 1] == _CARRIAGE_RETURN:
+                end -= 1
+            self._lines.append(str(self._view[begin:end], "ascii"))
+            begin = search_from = pos + 1
+        if begin > 0:
+            remaining = self._end - begin
+            self._view[:remaining] = self._view[begin : self._end]
+            self._end = remaining
+            self._wakeup()
+
+    def _wakeup(self) -> None:
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def readline(self) -> str:
+        while len(self._lines) == 0:
+            if self.exception is not None:
+                raise self.exception
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._lines.popleft()
+
+
+class AMI430SocketResource:
+    """
+    Drop in for the pyvisa resource of a 'TCPIP0::<host>::<port>::SOCKET' address.
+    """
+
+    def __init__(self, address: str, timeout_ms: float = 2000.0):
+        host_port = parse_socket_address(address)
+        assert host_port is not None, address
+        self.resource_name = address
+        self._host, self._port = host_port
+        self.timeout = timeout_ms
+        "Same unit as pyvisa: ms"
+        self.write_termination = "\n"
+        self.read_termination = "\n"
+        self._loop = _get_loop()
+        self._protocol: Optional[_LineProtocol] = None
+
+    def open(self) -> None:
+        async def connect():
+            _transport, protocol = await self._loop.create_connection(
+                _LineProtocol, self._host, self._port
+            )
+            return protocol
+
+        self._protocol = self._run(connect(), timeout_s=self.timeout / 1000.0)
+
+    def _run(self, coro, timeout_s: Optional[float]):
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, timeout=timeout_s), self._loop
+        )
+        try:
+            return future.result()
+        except asyncio.TimeoutError as e:
+            raise pyvisa.VisaIOError(pyvisa.constants.StatusCode.error_timeout) from e
+
+    def _timeout_s(self, timeout_s: Optional[float]) -> float:
+        if timeout_s is None:
+            return self.timeout / 1000.0
+        return timeout_s
+
+    def _encode(self, cmds: Sequence[str]) -> bytes:
+        return "".join(cmd + self.write_termination for cmd in cmds).encode("ascii")
+
+    def _check_connected(self) -> None:
+        """
+        Called in the event loop before writing: 'transport.write' on a lost
+        connection does not raise.
+        """
+        if self._protocol.exception is not None:
+            raise self._protocol.exception
+        if self._protocol.transport.is_closing():
+            raise ConnectionResetError(f"{self.resource_name}: Connection closed")
+
+    def write(self, cmd: str) -> None:
+        data = self._encode((cmd,))
+
+        async def write():
+            self._check_connected()
+            self._protocol.transport.write(data)
+
+        self._run(write(), self._timeout_s(None))
+
+    def read(self, timeout_s: Optional[float] = None) -> str:
+        return self._run(self._protocol.readline(), self._timeout_s(timeout_s))
+
+    def query(self, cmd: str, timeout_s: Optional[float] = None) -> str:
+        return self.query_pipelined((cmd,), timeout_s=timeout_s)[0]
+
+    def query_pipelined(
+        self, cmds: Sequence[str], timeout_s: Optional[float] = None
+    ) -> List[str]:
+        """
+        All queries leave in one segment, then the responses are collected in order.
+        'timeout_s' is the timeout for the complete request.
+        """
+        data = self._encode(cmds)
+
+        async def query():
+            self._check_connected()
+            self._protocol.transport.write(data)
+            return [await self._protocol.readline() for _ in cmds]
+
+        return self._run(query(), self._timeout_s(timeout_s))
+
+    def clear(self) -> None:
+        """
+        The socket was just opened: There is nothing stale to be cleared.
+        The welcome message of the AMI430 is still to be read by the caller.
+        """
+
+    def close(self) -> None:
+        if self._protocol is not None:
+            self._loop.call_soon_threadsafe(self._protocol.transport.close)
+            self._protocol = None
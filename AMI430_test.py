@@ -1,9 +1,31 @@
+import time
+import socket
+import dataclasses
+import threading
+from typing import Dict, List
+
 import pytest
 import numpy as np
+import pyvisa
 
-from AMI430_utils import Station, FieldLimitViolation
-from AMI430_visa import VisaStation
+from AMI430_utils import Station, FieldLimitViolation, segmented_ramp_duration_s
+from AMI430_utils import VisaReplay
+from AMI430_visa import VisaStation, StationSnapshot, MagnetSnapshot
+from AMI430_visa import vector_ramp_rates, predict_phase_s, MagnetRampingState
+from AMI430_visa import AMI430State, LabberState
+from AMI430_visa import VisaMagnetException, RampTimeoutException
+from AMI430_driver_utils import Quantity
+from AMI430_socket import AMI430SocketResource
+from AMI430_metrics import LatencyHistogram, command_verb
+from AMI430_thread import ReadWriteLock
+from AMI430_planner import plan_path
+from AMI430_history import RampHistory, RampRecord
+from AMI430_recorder import ScpiReplaySession
+from AMI430_driver_utils import DriverAbortException
+import AMI430_thread
+import AMI430_visa
 
+import AMI430_driver_config_simulation
 import AMI430_driver_config_sofia
 import AMI430_driver_config_tabea
 
@@ -11,6 +33,116 @@ sofia = AMI430_driver_config_sofia.get_station()
 #tabea = AMI430_driver_config_tabea.get_station()
 
 
+@pytest.fixture(autouse=True)
+def tmp_directory(tmp_path, monkeypatch):
+    "Log files and ramp histories are not written next to the driver."
+    monkeypatch.setattr(AMI430_visa, "DIRECTORY_TMP", tmp_path)
+
+
+@pytest.fixture
+def sofia_station() -> VisaStation:
+    "Sofia without supplies: Only the state machines and the configuration."
+    visa_station = VisaStation(station=sofia)
+    visa_station.open(initialize_visa=False)
+    return visa_station
+
+
+@pytest.fixture
+def idle_thread(monkeypatch) -> AMI430_thread.VisaThread:
+    "The simulation, but the visa thread never ticks: Nothing is published."
+    monkeypatch.setattr(AMI430_thread.VisaThread, "start", lambda self: None)
+    thread = AMI430_thread.VisaThread(
+        station=AMI430_driver_config_simulation.get_station()
+    )
+    yield thread
+    thread.visa_station.close()
+
+
+def open_lazy_station() -> VisaStation:
+    "The simulation with a switch heater on Z, cooled lazily. Only Z is to be ramped."
+    simulation = AMI430_driver_config_simulation.get_station()
+    visa_station = VisaStation(
+        station=dataclasses.replace(
+            simulation,
+            z_axis=dataclasses.replace(simulation.x_axis, ip_address="GPIB::3::INSTR"),
+            validate_field_limit=sofia.validate_field_limit,
+        )
+    )
+    visa_station.open()
+    visa_station.set_quantity(Quantity.ControlSwitchheaterCoolDelay, 0.1)
+    visa_station.set_quantity(Quantity.ControlHoldSwitchheaterOn, "False")
+    for visa_magnet in visa_station.visa_magnets:
+        visa_magnet.field_setpoint_Tesla = visa_magnet.snapshot().field_T
+    return visa_station
+
+
+def follow_commands(monkeypatch, visa_station: VisaStation) -> Dict[str, List[str]]:
+    """
+    The simulation always reports HOLDING: Report the state a supply reaches after each command.
+    Returns the commands written per magnet.
+    """
+    states = {
+        "RAMP": AMI430State.HOLDING,
+        "PAUSE": AMI430State.PAUSED,
+        "PS": AMI430State.PAUSED,
+        "ZERO": AMI430State.AT_ZERO_CURRENT,
+    }
+    commands: Dict[str, List[str]] = {}
+    for visa_magnet in visa_station.visa_magnets:
+        written = commands[visa_magnet.name] = []
+        state = [AMI430State.HOLDING]
+
+        def write_raw(
+            cmd, write_raw=visa_magnet.write_raw, written=written, state=state
+        ):
+            written.append(cmd)
+            write_raw(cmd)
+            state[0] = states.get(command_verb(cmd), state[0])
+
+        def ask_pipelined_raw(
+            cmds,
+            verb=None,
+            ask_pipelined_raw=visa_magnet._ask_pipelined_raw,
+            state=state,
+        ):
+            responses = ask_pipelined_raw(cmds, verb=verb)
+            return [
+                str(state[0].value) if cmd == "STATE?" else response
+                for cmd, response in zip(cmds, responses)
+            ]
+
+        monkeypatch.setattr(visa_magnet, "write_raw", write_raw)
+        monkeypatch.setattr(visa_magnet, "_ask_pipelined_raw", ask_pipelined_raw)
+    return commands
+
+
+def tick_till_done(visa_station: VisaStation) -> None:
+    for _ in range(20):
+        visa_station.tick()
+        if visa_station._state_machine.done:
+            return
+    raise AssertionError(f"Not done: {visa_station.statetext}")
+
+
+def set_snapshots(
+    visa_station: VisaStation,
+    field_T,
+    state: AMI430State = AMI430State.HOLDING,
+    switchheater_state: int = 1,
+) -> None:
+    "'field_T': Per magnet. Recent: The station plans without VISA traffic."
+    for visa_magnet, magnet_field_T in zip(visa_station.visa_magnets, field_T):
+        visa_magnet._recent_snapshot = MagnetSnapshot(
+            name=visa_magnet.name,
+            time_s=time.time(),
+            state=state,
+            field_T=magnet_field_T,
+            switchheater_state=switchheater_state,
+            current_magnet_A=0.0,
+            quench_state=0,
+        )
+
+
 def verify_field(station: Station, x: float, y: float, z: float):
     visa_station = VisaStation(station)
     visa_station.open(initialize_visa=False)
@@ -58,3 +190,637 @@ def test_limits_valid(station: Station, x: float, y: float, z: float):
 def test_limits_violation(station: Station, x: float, y: float, z: float):
     with pytest.raises(FieldLimitViolation):
         verify_field(station, x, y, z)
+
+
+class FakeAMI430Supply:
+    """
+    A minimal AMI430 on a local TCP port: Sends the welcome message and
+    answers the queries from 'responses'. Commands are recorded.
+    """
+
+    def __init__(self, responses: dict):
+        self.responses = responses
+        self.commands = []
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen()
+        self.address = f"TCPIP0::127.0.0.1::{self._server.getsockname()[1]}::SOCKET"
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            connection, _ = self._server.accept()
+            connection.sendall(
+                b"American Magnetics Model 430 IP Interface\r\nHello.\r\n"
+            )
+            for line in connection.makefile("rb"):
+                cmd = line.decode("ascii").strip()
+                self.commands.append(cmd)
+                if cmd in self.responses:
+                    connection.sendall(f"{self.responses[cmd]}\r\n".encode("ascii"))
+
+
+def test_asyncio_socket_resource():
+    supply = FakeAMI430Supply({"STATE?": 2, "FIELD:MAG?": 0.5})
+    resource = AMI430SocketResource(supply.address)
+    resource.open()
+    assert resource.read() == "American Magnetics Model 430 IP Interface"
+    assert resource.read() == "Hello."
+    resource.write("PAUSE")
+    assert resource.query("STATE?") == "2"
+    assert resource.query_pipelined(("STATE?", "FIELD:MAG?", "STATE?")) == [
+        "2",
+        "0.5",
+        "2",
+    ]
+    with pytest.raises(pyvisa.VisaIOError):
+        resource.query("QU?", timeout_s=0.1)
+    resource.close()
+    assert supply.commands[:2] == ["PAUSE", "STATE?"]
+
+
+def test_asyncio_socket_resource_write_lost():
+    supply = FakeAMI430Supply(responses={})
+    resource = AMI430SocketResource(supply.address)
+    resource.open()
+    resource.write("PAUSE")
+    resource._loop.call_soon_threadsafe(resource._protocol.transport.close)
+    # The PAUSE is not reported as delivered
+    with pytest.raises(ConnectionResetError):
+        resource.write("PAUSE")
+
+
+def test_recorder_replay(tmp_path):
+    filename = tmp_path / "scpi.tsv"
+    simulation = AMI430_driver_config_simulation.get_station()
+    visa_station = VisaStation(
+        station=dataclasses.replace(simulation, visa_recording_filename=filename)
+    )
+    visa_station.open()
+    recorded = visa_station.snapshots()
+    visa_station.close()
+
+    replay = dataclasses.replace(
+        simulation, use_visa_simulation=VisaReplay(filename=str(filename))
+    )
+    visa_station = VisaStation(station=replay)
+    start_s = time.time()
+    visa_station.open()
+    replayed = visa_station.snapshots()
+    replay_s = time.time() - start_s
+    visa_station.close()
+    for name, snapshot in recorded.items():
+        assert replayed[name].field_T == snapshot.field_T
+        assert replayed[name].state == snapshot.state
+    # The axes are replayed concurrently, every exchange as long as recorded
+    recorded_s = {}
+    for line in filename.read_text(encoding="ascii").splitlines():
+        fields = line.split("\t")
+        recorded_s[fields[2]] = recorded_s.get(fields[2], 0.0) + float(fields[1])
+    assert replay_s >= 0.5 * max(recorded_s.values())
+
+
+def test_replay_exchange_timing(tmp_path):
+    filename = tmp_path / "scpi.tsv"
+    # A pipelined exchange stores its duration on the first line only
+    filename.write_text(
+        "100.000\t0.2000\tZ\tQ\tSTATE?\t2\n"
+        "100.000\t0.0000\tZ\tQ\tFIELD:MAG?\t0.5\n"
+        "101.000\t0.1000\tZ\tQ\tFIELD:MAG?\t0.6\n"
+        "101.000\t0.0000\tZ\tQ\tSTATE?\t3\n",
+        encoding="ascii",
+    )
+    session = ScpiReplaySession(filename, time_compression=2.0)
+    start_s = time.time()
+    assert session.exchange("Z", "STATE?") == "2"
+    assert session.exchange("Z", "FIELD:MAG?") == "0.5"
+    # The exchange took 0.2s as recorded, compressed by 2
+    assert time.time() - start_s == pytest.approx(0.1, abs=0.05)
+    assert session.exchange("Z", "QU?") == "ERROR"
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile_s(50.0) == 0.0
+    for _ in range(98):
+        histogram.record(0.002)
+    histogram.record(0.5)
+    histogram.record(0.9)
+    assert 0.002 <= histogram.percentile_s(50.0) < 0.0026
+    assert 0.5 <= histogram.percentile_s(99.0) < 0.64
+    assert histogram.percentile_s(100.0) == 0.9
+    assert histogram.count == 100
+
+
+def test_read_write_lock():
+    lock = ReadWriteLock()
+    events = []
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    with lock.read():
+        with lock.read():
+            # Readers share the lock
+            pass
+        thread = threading.Thread(target=writer)
+        thread.start()
+        thread.join(timeout=0.2)
+        # The writer waits for the reader
+        assert events == []
+    thread.join(timeout=1.0)
+    assert events == ["write"]
+
+
+def test_station_snapshot():
+    magnet = MagnetSnapshot(
+        name="Z",
+        time_s=time.time() - 0.3,
+        state=AMI430State.RAMPING,
+        field_T=0.25,
+        switchheater_state=1,
+        current_magnet_A=5.0,
+        quench_state=0,
+    )
+    snapshot = StationSnapshot(
+        time_s=magnet.time_s,
+        magnets={"Z": magnet},
+        labber_state=LabberState.RAMPING,
+        switchheater_state=1,
+    )
+    assert snapshot.get_quantity(Quantity.StatusFieldActualZ) == 0.25
+    assert snapshot.get_quantity(Quantity.StatusMagnetStateZ) == "RAMPING"
+    assert snapshot.get_quantity(Quantity.ControlLabberState) == "RAMPING"
+    assert snapshot.get_quantity(Quantity.StatusSnapshotAge) >= 0.3
+    with pytest.raises(KeyError):
+        # Configuration is not published
+        snapshot.get_quantity(Quantity.ControlSetpointZ)
+
+
+def test_ramping_statemachine_abort(sofia_station: VisaStation):
+    visa_station = sofia_station
+    state_machine = visa_station._state_machine
+    state_machine._magnets_to_be_ramped.extend(visa_station.visa_magnets)
+    state_machine.done = False
+    state_machine.abort_requested = True
+    # Aborting: The magnets are not touched anymore
+    state_machine.tick()
+    assert visa_station.statetext == "X,Y,Z"
+    state_machine.abort()
+    assert state_machine.done
+    assert not state_machine.abort_requested
+    assert visa_station.statetext == ""
+
+
+def test_abort_pause_failed(sofia_station: VisaStation):
+    visa_station = sofia_station
+    # Without supplies: Every PAUSE raises
+    assert not visa_station.pause_all()
+    visa_station.abort()
+    assert visa_station.metrics.histogram(verb="ABORT_FAILED").count == 1
+    assert visa_station.metrics.histogram(verb="ABORT").count == 0
+    assert visa_station.get_quantity(Quantity.StatusAbortLatency) == 0.0
+
+
+def test_visa_thread_supervisor(monkeypatch):
+    def crash(self):
+        raise DriverAbortException("crash")
+
+    monkeypatch.setattr(AMI430_thread, "RESTART_DELAY_S", 0.01)
+    monkeypatch.setattr(AMI430_thread.VisaThread, "_tick", crash)
+    thread = AMI430_thread.VisaThread(
+        station=AMI430_driver_config_simulation.get_station()
+    )
+    thread.join(timeout=5.0)
+    # The supervisor gave up
+    assert not thread.is_alive()
+    assert thread.restart_count == AMI430_thread.RESTARTS_MAX
+    assert thread.get_value(Quantity.ControlLabberState.value) == "ERROR"
+    assert (
+        thread.get_value(Quantity.StatusWorkerRestarts.value)
+        == AMI430_thread.RESTARTS_MAX
+    )
+    thread.stop()
+
+
+def test_find_field_limit_violation(sofia_station: VisaStation, monkeypatch):
+    visa_station = sofia_station
+    start_T = {"X": 0.0, "Y": 0.0, "Z": 0.0}
+    assert (
+        visa_station.find_field_limit_violation(
+            start_T=start_T, target_T={"X": 0.5, "Y": 0.5, "Z": 0.5}
+        )
+        is None
+    )
+    # Both targets are allowed, but not ramping X and Z at the same time
+    assert visa_station.is_field_allowed({"X": 0.8, "Y": 0.0, "Z": 0.0})
+    assert visa_station.is_field_allowed({"X": 0.0, "Y": 0.0, "Z": 0.8})
+    violation = visa_station.find_field_limit_violation(
+        start_T={"X": 0.8, "Y": 0.0, "Z": 0.0}, target_T={"X": 0.0, "Y": 0.0, "Z": 0.8}
+    )
+    assert violation is not None
+    assert not visa_station.is_field_allowed(violation)
+    # Corners and zero crossings only: Z crosses zero
+    fields_T = []
+    is_field_allowed = visa_station.is_field_allowed
+
+    def is_field_allowed_recorded(field_T):
+        fields_T.append(field_T)
+        return is_field_allowed(field_T)
+
+    monkeypatch.setattr(visa_station, "is_field_allowed", is_field_allowed_recorded)
+    assert (
+        visa_station.find_field_limit_violation(
+            start_T={"X": 0.1, "Y": 0.0, "Z": -0.5},
+            target_T={"X": 0.2, "Y": 0.3, "Z": 0.5},
+        )
+        is None
+    )
+    assert len(fields_T) == 2 * 2 * 3
+    assert {"X": 0.2, "Y": 0.3, "Z": 0.0} in fields_T
+
+
+def test_vector_ramp_rates():
+    duration_s, rates_Tpers = vector_ramp_rates(
+        distance_T={"X": 0.1, "Y": -0.4, "Z": 0.0},
+        rate_max_Tpers={"X": 0.01, "Y": 0.01, "Z": 0.01},
+    )
+    # Y is the slowest: It ramps at the maximal rate
+    assert duration_s == pytest.approx(40.0)
+    assert rates_Tpers["Y"] == pytest.approx(0.01)
+    assert rates_Tpers["X"] == pytest.approx(0.0025)
+    assert rates_Tpers["Z"] > 0.0
+
+
+def test_plan_path(sofia_station: VisaStation):
+    visa_station = sofia_station
+    rate_Tpers = {"X": 0.01, "Y": 0.01, "Z": 0.01}
+    # Straight line
+    plan = plan_path(
+        start_T={"X": 0.0, "Y": 0.0, "Z": 0.0},
+        target_T={"X": 0.5, "Y": 0.0, "Z": 0.5},
+        rate_Tpers=rate_Tpers,
+        is_field_allowed=visa_station.is_field_allowed,
+    )
+    assert len(plan.legs) == 1
+    assert plan.legs[0].vector
+    assert plan.duration_s == pytest.approx(50.0)
+    # Y has to be zero before X is ramped
+    plan = plan_path(
+        start_T={"X": 0.0, "Y": 2.0, "Z": 0.0},
+        target_T={"X": 0.5, "Y": 0.0, "Z": 0.0},
+        rate_Tpers=rate_Tpers,
+        is_field_allowed=visa_station.is_field_allowed,
+    )
+    assert plan.legs[0].order == ("Y", "X")
+    assert plan.duration_s == pytest.approx(250.0)
+    with pytest.raises(FieldLimitViolation):
+        plan_path(
+            start_T={"X": 0.0, "Y": 0.0, "Z": 0.0},
+            target_T={"X": 0.5, "Y": 2.0, "Z": 0.0},
+            rate_Tpers=rate_Tpers,
+            is_field_allowed=visa_station.is_field_allowed,
+        )
+
+
+def test_planned_without_ramp_rate(sofia_station: VisaStation):
+    visa_station = sofia_station
+    visa_station.set_quantity(Quantity.ControlRampMode, "PLANNED")
+    for visa_magnet, setpoint_T in zip(visa_station.visa_magnets, (0.5, 0.0, 0.5)):
+        # The ramp rate is 0 till Labber sets it
+        assert visa_magnet.field_ramp_TeslaPers == 0.0
+        visa_magnet.field_setpoint_Tesla = setpoint_T
+    set_snapshots(visa_station, field_T=(0.0, 0.0, 0.0))
+    visa_station._state_machine.start_ramping()
+    # No straight line: The rates can not be scaled
+    assert visa_station.statetext == "X,Z,Y"
+    assert visa_station._state_machine._ramp_mode.name == "SEQUENTIAL"
+
+
+def test_planned_without_path(sofia_station: VisaStation):
+    visa_station = sofia_station
+    visa_station.set_quantity(Quantity.ControlRampMode, "PLANNED")
+    for visa_magnet, setpoint_T in zip(visa_station.visa_magnets, (0.5, 2.0, 0.0)):
+        visa_magnet.field_setpoint_Tesla = setpoint_T
+    set_snapshots(visa_station, field_T=(0.0, 0.0, 0.0))
+    with pytest.raises(FieldLimitViolation):
+        visa_station._state_machine.start_ramping()
+    # Nothing queued: The next tick does not ramp
+    assert visa_station._state_machine.done
+    assert visa_station.statetext == ""
+
+
+def test_ramp_history_prediction(sofia_station: VisaStation):
+    visa_station = sofia_station
+    visa_magnet = visa_station.visa_magnet_z
+    # Nothing learned yet: Distance and rate only
+    assert predict_phase_s(
+        visa_magnet,
+        MagnetRampingState.WAITFOR_HOLDING,
+        start_T=0.5,
+        target_T=0.0,
+        rate_Tpers=0.01,
+    ) == pytest.approx(50.0)
+    for overhead_s in (2.0, 3.0, 4.0):
+        visa_station.ramp_history.append(
+            RampRecord(
+                magnet="Z",
+                time_s=time.time(),
+                from_T=0.0,
+                to_T=1.0,
+                rate_Tpers=0.1,
+                phases_s={
+                    "WAITFOR_HOLDING": 10.0 + overhead_s,
+                    "WAITFOR_SWITCH_COLD": 30.0,
+                },
+                switchheater_switches=2,
+            )
+        )
+    assert predict_phase_s(
+        visa_magnet,
+        MagnetRampingState.WAITFOR_HOLDING,
+        start_T=0.5,
+        target_T=0.0,
+        rate_Tpers=0.01,
+    ) == pytest.approx(53.0)
+    assert predict_phase_s(
+        visa_magnet,
+        MagnetRampingState.WAITFOR_SWITCH_COLD,
+        start_T=0.0,
+        target_T=0.0,
+        rate_Tpers=0.01,
+    ) == pytest.approx(30.0)
+    # Learned again after a restart
+    history = RampHistory(filename=visa_station.ramp_history.filename)
+    assert history.ramp_overhead_s("Z", "WAITFOR_HOLDING") == pytest.approx(3.0)
+
+
+def test_setpoint_list(sofia_station: VisaStation):
+    visa_station = sofia_station
+    values = [0.0, 0.5, 1.0, 2.0, 0.0, 0.0, 0.5, 0.0]
+    visa_station.set_quantity(Quantity.ControlSetpointList, values)
+    assert len(visa_station.setpoint_list) == 2
+    assert visa_station.setpoint_list[0].field_T == {"X": 0.0, "Y": 0.5, "Z": 1.0}
+    assert visa_station.setpoint_list[0].dwell_s == 2.0
+    assert visa_station.get_quantity(Quantity.ControlSetpointList) == values
+    # Validated up front: The loaded list is kept
+    with pytest.raises(FieldLimitViolation):
+        visa_station.set_quantity(
+            Quantity.ControlSetpointList, values + [0.0, 0.0, 7.0, 0.0]
+        )
+    with pytest.raises(ValueError):
+        visa_station.set_quantity(Quantity.ControlSetpointList, values[:-1])
+    assert len(visa_station.setpoint_list) == 2
+
+
+def test_segmented_ramp_duration():
+    segments_Tpers = ((1.0, 0.02), (3.0, 0.01))
+    # Through zero: The segment is chosen by abs(field)
+    assert segmented_ramp_duration_s(-0.5, 2.0, segments_Tpers) == pytest.approx(
+        25.0 + 50.0 + 100.0
+    )
+    assert segmented_ramp_duration_s(2.0, 1.5, segments_Tpers) == pytest.approx(50.0)
+
+
+def test_lazy_cooling_policy(sofia_station: VisaStation):
+    visa_station = sofia_station
+    assert not visa_station.lazy_cooling
+    visa_station.set_quantity(Quantity.ControlSwitchheaterCoolDelay, 60.0)
+    # The switch heater is held on anyway
+    assert not visa_station.lazy_cooling
+    visa_station.set_quantity(Quantity.ControlHoldSwitchheaterOn, "False")
+    assert visa_station.lazy_cooling
+
+
+def test_lazy_cooling_ticks(monkeypatch):
+    visa_station = open_lazy_station()
+    commands = follow_commands(monkeypatch, visa_station)
+    visa_magnet = visa_station.visa_magnet_z
+    visa_magnet.field_setpoint_Tesla = 0.5
+    visa_station.start_ramping()
+    tick_till_done(visa_station)
+    # The switch heater is kept warm
+    assert "PS 1" in commands["Z"]
+    assert "PS 0" not in commands["Z"]
+    # A ramp within the delay: No current matching, no heating
+    commands["Z"].clear()
+    visa_magnet.field_setpoint_Tesla = 0.7
+    visa_station.start_ramping()
+    tick_till_done(visa_station)
+    assert commands["Z"][0] == "PAUSE"
+    assert "PS 1" not in commands["Z"]
+    assert commands["Z"].count("RAMP") == 1
+    assert visa_station.get_quantity(Quantity.StatusSwitchheaterTimeSaved) > 0.0
+    # No ramp within the delay: Cooled at the setpoint
+    commands["Z"].clear()
+    visa_station.tick()
+    assert "PS 0" not in commands["Z"]
+    time.sleep(0.2)
+    tick_till_done(visa_station)
+    assert "PS 0" in commands["Z"]
+    assert visa_magnet.snapshot().field_T == pytest.approx(0.7)
+    visa_station.close()
+
+
+def test_lazy_cooling_abort_and_close(monkeypatch):
+    visa_station = open_lazy_station()
+    commands = follow_commands(monkeypatch, visa_station)
+    visa_magnet = visa_station.visa_magnet_z
+    visa_magnet.field_setpoint_Tesla = 0.5
+    visa_station.start_ramping()
+    tick_till_done(visa_station)
+    # A ramp violating the field limit does not start: The cooling stays due
+    visa_station.set_quantity(Quantity.ControlRampMode, "PLANNED")
+    visa_magnet.field_setpoint_Tesla = 7.0
+    with pytest.raises(FieldLimitViolation):
+        visa_station.start_ramping()
+    visa_station.set_quantity(Quantity.ControlRampMode, "SEQUENTIAL")
+    assert visa_station.get_quantity(Quantity.StatusSwitchheaterTimeSaved) == 0.0
+    # Aborted before Z moved: The switch heater is cooled at 0.5 T after the delay
+    visa_magnet.field_setpoint_Tesla = 0.7
+    visa_station.start_ramping()
+    visa_station.abort()
+    commands["Z"].clear()
+    visa_station.tick()
+    time.sleep(0.2)
+    tick_till_done(visa_station)
+    assert "PS 0" in commands["Z"]
+    assert "CONF:FIELD:TARG 0.700000" not in commands["Z"]
+    # Closed within the delay: The switch heater is cooled at once
+    visa_magnet.field_setpoint_Tesla = 0.5
+    visa_station.start_ramping()
+    tick_till_done(visa_station)
+    commands["Z"].clear()
+    visa_station.close()
+    assert commands["Z"] == ["PS 0"]
+
+
+def test_unchanged_axes_not_queued(sofia_station: VisaStation):
+    visa_station = sofia_station
+    # The readback differs from the target reached: X is unchanged.
+    # Y was at 0.09995 T: A step smaller than the readback noise still ramps.
+    for visa_magnet, field_actual_T in zip(
+        visa_station.visa_magnets, (0.1, 0.09995, 0.3)
+    ):
+        visa_magnet.field_setpoint_Tesla = 0.1
+        visa_magnet.field_actual_Tesla = field_actual_T
+    set_snapshots(visa_station, field_T=(0.10001, 0.09999, 0.3))
+    visa_station._state_machine.start_ramping()
+    assert visa_station.statetext == "Z,Y"
+    # A write may change the status
+    visa_station.visa_magnet_x._invalidate_tick_cache("PS 0")
+    assert visa_station.visa_magnet_x._recent_snapshot is None
+
+
+def test_prewarm_queued_switchheater(sofia_station: VisaStation):
+    visa_station = sofia_station
+    for visa_magnet in visa_station.visa_magnets:
+        visa_magnet.field_setpoint_Tesla = 0.15
+    set_snapshots(
+        visa_station,
+        field_T=(0.1, 0.2, 0.0),
+        state=AMI430State.AT_ZERO_CURRENT,
+        switchheater_state=0,
+    )
+    visa_station._state_machine.start_ramping()
+    # Z with the cold switch heater is queued behind Y: Warmed meanwhile
+    assert visa_station.statetext == "Y,X,Z-INIT"
+    visa_station._state_machine.abort()
+    assert visa_station.statetext == ""
+
+
+def test_get_group_snapshot(idle_thread: AMI430_thread.VisaThread, monkeypatch):
+    thread = idle_thread
+    assert thread.visa_station.published_snapshot is None
+    thread.begin_get_group_sync()
+
+    def get_quantity(quantity):
+        raise AssertionError(f"Not answered from the snapshot: {quantity}")
+
+    # The rest of the group is answered without VISA traffic
+    monkeypatch.setattr(thread.visa_station, "get_quantity", get_quantity)
+    for quantity in (
+        Quantity.StatusFieldActualX,
+        Quantity.StatusFieldActualY,
+        Quantity.StatusFieldActualZ,
+        Quantity.StatusMagnetStateZ,
+    ):
+        thread.get_value(quantity.value)
+    thread.end_get_group()
+    with pytest.raises(AssertionError):
+        thread.get_value(Quantity.StatusFieldActualZ.value)
+
+
+def test_tick_cache_per_thread(sofia_station: VisaStation, monkeypatch):
+    visa_station = sofia_station
+    visa_magnet = visa_station.visa_magnet_z
+    asked = []
+
+    def ask_pipelined_raw(cmds, verb=None):
+        asked.extend(cmds)
+        return ["2"] * len(cmds)
+
+    monkeypatch.setattr(visa_magnet, "_ask_pipelined_raw", ask_pipelined_raw)
+    with visa_station.tick_scope():
+        # The workers of 'for_each_magnet()' share the tick of their caller
+        visa_station.for_each_magnet(
+            lambda m: m.ask_raw("STATE?"), visa_magnets=[visa_magnet]
+        )
+        assert visa_magnet.ask_raw("STATE?") == "2"
+        # Another thread does not see the cached response
+        labber_thread = threading.Thread(target=lambda: visa_magnet.ask_raw("STATE?"))
+        labber_thread.start()
+        labber_thread.join()
+    assert asked == ["STATE?", "STATE?"]
+
+
+def test_close_shuts_down_workers():
+    visa_station = VisaStation(station=AMI430_driver_config_simulation.get_station())
+    visa_station.open()
+    visa_station.close()
+    with pytest.raises(RuntimeError):
+        visa_station.for_each_magnet(lambda visa_magnet: None)
+
+
+def test_ramp_wait_survives_reconnect(monkeypatch):
+    simulation = AMI430_driver_config_simulation.get_station()
+    visa_station = VisaStation(
+        station=dataclasses.replace(
+            simulation, validate_field_limit=sofia.validate_field_limit
+        )
+    )
+    visa_station.open()
+    ramp_done = visa_station.start_ramp_wait()
+    visa_magnet = visa_station.visa_magnet_z
+
+    def timeout(*args, **kwargs):
+        raise pyvisa.VisaIOError(pyvisa.constants.VI_ERROR_TMO)
+
+    monkeypatch.setattr(visa_magnet.visa_handle, "query", timeout)
+    monkeypatch.setattr(visa_magnet.visa_handle, "write", timeout)
+    with pytest.raises(VisaMagnetException):
+        visa_station.tick()
+    # Reconnect pending: Labber keeps waiting
+    assert not visa_magnet.connected
+    assert not ramp_done.done()
+
+    def ramp_timeout():
+        raise RampTimeoutException("Timeout")
+
+    visa_magnet._reconnect_at_s = time.time()
+    monkeypatch.setattr(visa_station, "_tick", ramp_timeout)
+    with pytest.raises(RampTimeoutException):
+        visa_station.tick()
+    assert visa_magnet.connected
+    assert isinstance(ramp_done.exception(), RampTimeoutException)
+    visa_station.close()
+
+
+def test_reconnect_backoff_flapping(monkeypatch):
+    visa_station = VisaStation(station=AMI430_driver_config_simulation.get_station())
+    visa_station.open()
+    visa_magnet = visa_station.visa_magnet_z
+
+    def timeout(*args, **kwargs):
+        raise pyvisa.VisaIOError(pyvisa.constants.VI_ERROR_TMO)
+
+    def lose_and_reconnect():
+        with monkeypatch.context() as m:
+            m.setattr(visa_magnet.visa_handle, "query", timeout)
+            with pytest.raises(VisaMagnetException):
+                visa_magnet.ask_raw("STATE?")
+        visa_magnet._reconnect_at_s = time.time()
+        visa_magnet.maintain_connection()
+        assert visa_magnet.connected
+
+    lose_and_reconnect()
+    assert visa_magnet._reconnect_backoff_s == AMI430_visa.RECONNECT_BACKOFF_MIN_S
+    # Lost again right after the reconnect: The backoff grows
+    lose_and_reconnect()
+    assert visa_magnet._reconnect_backoff_s == 2 * AMI430_visa.RECONNECT_BACKOFF_MIN_S
+    visa_magnet.ask_raw("STATE?")
+    assert visa_magnet._reconnect_backoff_s == 2 * AMI430_visa.RECONNECT_BACKOFF_MIN_S
+    # Stable: The first I/O after the window resets the backoff
+    monkeypatch.setattr(AMI430_visa, "RECONNECT_STABLE_S", 0.0)
+    visa_magnet.ask_raw("STATE?")
+    assert visa_magnet._reconnect_backoff_s == AMI430_visa.RECONNECT_BACKOFF_MIN_S
+    visa_station.close()
+
+
+def test_wait_till_ramped_stopped(idle_thread: AMI430_thread.VisaThread, monkeypatch):
+    thread = idle_thread
+    monkeypatch.setattr(
+        thread.visa_station,
+        "station",
+        dataclasses.replace(
+            thread.station, validate_field_limit=sofia.validate_field_limit
+        ),
+    )
+    monkeypatch.setattr(AMI430_thread, "RAMP_WAIT_POLL_S", 0.01)
+    # The ramp is not over: No tick resolves the wait
+    monkeypatch.setattr(AMI430_thread.VisaThread, "worker_alive", True)
+    stopped = iter((False, True))
+    labber_state = thread.wait_till_ramped_sync(is_stopped=lambda: next(stopped))
+    assert labber_state is LabberState.PAUSED
+    assert thread.visa_station._state_machine.done
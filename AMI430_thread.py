@@ -1,7 +1,11 @@
 import time
 import logging
+import collections
 import threading
+import contextlib
+import concurrent.futures
 import enum
+from typing import Callable, Optional
 
 import AMI430_visa
 from AMI430_driver_utils import DriverAbortException
@@ -9,15 +13,71 @@ from AMI430_driver_utils import Quantity
 from AMI430_utils import Station
 
 TICK_INTERVAL_S = 0.5
+"A tick taking longer is logged as warning. The tick interval is adaptive, see 'VisaStation.next_tick_interval_s()'."
+RAMP_WAIT_POLL_S = 1.0
+"While waiting for a ramp: Check if the visa thread is still alive and Labber did not stop"
+METRICS_SUMMARY_INTERVAL_S = 60.0
+STOP_TIMEOUT_S = 10.0
+RESTART_DELAY_S = 1.0
+RESTARTS_MAX = 5
+RESTARTS_WINDOW_S = 60.0
+"More than RESTARTS_MAX restarts within RESTARTS_WINDOW_S: The supervisor gives up"
 
 logger = logging.getLogger("LabberDriver")
 
-LOCK = threading.Lock()
+
+class ReadWriteLock:
+    """
+    Many readers or one writer.
+    A waiting writer blocks new readers: A stream of Labber reads may not starve a write.
+    Not reentrant!
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._writers_waiting > 0:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer or self._readers > 0:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
 
 
-def synchronized(func):
+LOCK = ReadWriteLock()
+
+QUANTITIES_IMMUTABLE = {Quantity.ConfigName, Quantity.ConfigAxis}
+"These quantities never change: No lock required"
+
+
+def _synchronized(lock_method, func):
     def wrapper(*args, **kwargs):
-        with LOCK:
+        with lock_method():
             try:
                 return func(*args, **kwargs)
             except:  # pylint: disable=bare-except
@@ -27,6 +87,14 @@ def synchronized(func):
     return wrapper
 
 
+def synchronized_read(func):
+    return _synchronized(LOCK.read, func)
+
+
+def synchronized_write(func):
+    return _synchronized(LOCK.write, func)
+
+
 class VisaThread(threading.Thread):
     """
     EVERY communication between Labber GUI and visa_station is routed via this class!
@@ -38,16 +106,30 @@ class VisaThread(threading.Thread):
 
      - Synchronized access
        The two threads agree, that before accessing data, the 'LOCK' has to be aquired.
-       This is implement using @synchronized.
+       This is implement using @synchronized_read and @synchronized_write.
+       The write lock protects the configuration (setpoints, ramp rates, hold flags, mode)
+       and starting a ramp. Ticking and Labber reads only read the configuration
+       and may run concurrently: Every VisaMagnet serializes the access to its socket.
+       Immutable quantities (QUANTITIES_IMMUTABLE) are read without any lock.
+       Status quantities are read without any lock from 'VisaStation.published_snapshot'
+       which the visa thread replaces after every tick.
        Convention: The Labber GUI ONLY accesses methods with '_synq' in its name.
+
+     - Supervision
+       'run()' restarts the worker loop after an unexpected exception.
+       If it has to give up, the thread ends and 'Control / Labber State' reports ERROR.
     """
 
     def __init__(self, station: Station):
-        self.dict_values_labber_thread_copy = {}
         super().__init__(daemon=True)
         self._visa_station = AMI430_visa.VisaStation(station=station)
         logger.info(f"LabberThread(config='{self.station.name}')")
-        self._stopping = False
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        "Set by the labber thread to tick immediately: The configuration changed."
+        self.restart_count = 0
+        self._group_snapshot: Optional[AMI430_visa.StationSnapshot] = None
+        "Answers the status quantities of a Labber call group, see 'begin_get_group_sync()'"
         self._visa_station.open()
         self.start()
 
@@ -60,13 +142,45 @@ class VisaThread(threading.Thread):
         return self._visa_station
 
     def run(self):
-        while not self._stopping:
+        """
+        Supervisor: Restart the worker loop after an unexpected exception.
+        """
+        restarts_s = collections.deque()
+        while True:
+            try:
+                self._work()
+                return
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.error(f"Visa thread crashed: {ex!r}")
+                logger.exception(ex)
+                crash = ex
+
+            now_s = time.time()
+            restarts_s.append(now_s)
+            while now_s - restarts_s[0] > RESTARTS_WINDOW_S:
+                restarts_s.popleft()
+            if len(restarts_s) > RESTARTS_MAX:
+                logger.error(
+                    f"Visa thread: {len(restarts_s)} crashes within {RESTARTS_WINDOW_S:0.0f}s. Giving up!"
+                )
+                # A restart keeps the ramping state: Only now the ramp wait fails
+                self._fail_ramp_wait_sync(crash)
+                return
+            self.restart_count += 1
+            logger.warning(
+                f"Visa thread: Restart {self.restart_count} in {RESTART_DELAY_S:0.1f}s"
+            )
+            if self._stop_event.wait(timeout=RESTART_DELAY_S):
+                return
+
+    def _work(self):
+        metrics_summary_s = time.time() + METRICS_SUMMARY_INTERVAL_S
+        while not self._stop_event.is_set():
             start_s = time.time()
+            self._wakeup.clear()
             try:
                 self._tick()
-            except DriverAbortException as ex:
-                logger.error(f"AMI430_driver_utils.DriverAbortException(): {ex}")
-                logger.exception(ex)
+            except DriverAbortException:
                 raise
 
             except Exception as ex:
@@ -78,31 +192,91 @@ class VisaThread(threading.Thread):
                 logger.warning(
                     f"tick() took:{elapsed_s:0.3f}s. Expected <= {TICK_INTERVAL_S:0.3f}s"
                 )
-            time.sleep(TICK_INTERVAL_S)
+            if time.time() > metrics_summary_s:
+                metrics_summary_s += METRICS_SUMMARY_INTERVAL_S
+                logger.info(
+                    f"{AMI430_visa.LoggerTags.VISA_LATENCY.name} {self._visa_station.metrics.summary()}"
+                )
+            # Fixed cadence: The interval starts with the tick, not after it
+            next_tick_s = start_s + self._visa_station.next_tick_interval_s()
+            self._wakeup.wait(timeout=max(next_tick_s - time.time(), 0.0))
 
     def stop(self):
-        self._stopping = True
-        self.join(timeout=10.0)
+        """
+        Returns as soon as the current tick is over.
+        """
+        self._stop_event.set()
+        self._wakeup.set()
+        self.join(timeout=STOP_TIMEOUT_S)
+        if self.is_alive():
+            logger.warning(f"Visa thread did not stop within {STOP_TIMEOUT_S:0.1f}s")
+            return
+        self._visa_station.close()
+
+    @property
+    def worker_alive(self) -> bool:
+        return self.is_alive() and not self._stop_event.is_set()
 
-    @synchronized
+    @synchronized_write
+    def _fail_ramp_wait_sync(self, ex: Exception) -> None:
+        self._visa_station.fail_ramp_wait(ex)
+
+    @synchronized_read
     def _tick(self) -> None:
         """
-        Called by the thread: synchronized to make sure that the labber GUI is blocked
+        Called by the thread: synchronized to make sure that the configuration does not change
         """
         self._visa_station.tick()
-        # Create a copy of all values to allow access for the labber thread without any delay.
-        # self.dict_values_labber_thread_copy = self._visa_station.dict_values.copy()
 
-    @synchronized
     def set_quantity_sync(self, quantity: Quantity, value):
         """
         Called by labber GUI
         """
-        return self._visa_station.set_quantity(quantity=quantity, value=value)
+        if quantity is Quantity.ControlLabberState:
+            if value == AMI430_visa.LabberState.PAUSED.name:
+                # Abort: Pause the supplies before waiting for the lock
+                self._visa_station.request_abort()
+        return self._set_quantity_sync(quantity=quantity, value=value)
+
+    @synchronized_write
+    def _set_quantity_sync(self, quantity: Quantity, value):
+        value_new = self._visa_station.set_quantity(quantity=quantity, value=value)
+        self._wakeup.set()
+        return value_new
+
+    def wait_till_ramped_sync(
+        self, is_stopped: Callable[[], bool] = lambda: False
+    ) -> AMI430_visa.LabberState:
+        """
+        Called by labber GUI: Blocks till the visa thread reports the ramp to be over.
+        The lock is only held to start the ramp: Status reads and aborts stay responsive.
+        'is_stopped': 'Driver.isStopped()'. While Labber is blocked here, setting
+        'Control / Labber State' can not arrive: The user stopping the measurement aborts the ramp.
+        """
+        ramp_done = self._start_ramp_wait_sync()
+        self._wakeup.set()
+        while True:
+            try:
+                return ramp_done.result(timeout=RAMP_WAIT_POLL_S)
+            except concurrent.futures.TimeoutError:
+                if not self.worker_alive:
+                    raise DriverAbortException(  # pylint: disable=raise-missing-from
+                        "The visa thread stopped while waiting for the ramp"
+                    )
+                if is_stopped():
+                    logger.info("Labber stopped while waiting for the ramp: Abort")
+                    self._visa_station.request_abort()
+                    self._abort_sync()
+                    return ramp_done.result()
 
-    @synchronized
-    def wait_till_ramped_sync(self):
-        self._visa_station.wait_till_ramped()
+    @synchronized_write
+    def _abort_sync(self) -> None:
+        self._visa_station.abort()
+        self._wakeup.set()
+
+    @synchronized_write
+    def _start_ramp_wait_sync(self) -> concurrent.futures.Future:
+        return self._visa_station.start_ramp_wait()
 
     def set_value(self, name: str, value):
         """
@@ -159,35 +333,79 @@ class VisaThread(threading.Thread):
         logger.warning("Settle/Timeout time over")
         return heater_wrapper.TEMPERATURE_SETTLE_OFF_K
 
-    @synchronized
+    @synchronized_write
     def set_quantity(self, quantity: Quantity, value):
-        return self._visa_station.set_quantity(quantity=quantity, value=value)
+        value_new = self._visa_station.set_quantity(quantity=quantity, value=value)
+        self._wakeup.set()
+        return value_new
 
     def get_value(self, name: str):
         """
-        This typically returns immedately as it accesses a copy of all values.
-        Only in rare cases, it will delay for max 0.5s.
+        Status quantities return immedately from the published snapshot.
+        If the snapshot is older than 'Control / Status Max Age',
+        the value is queried using the synchronized call.
         """
         assert isinstance(name, str)
         quantity = Quantity(name)
+        if quantity is Quantity.StatusWorkerRestarts:
+            return self.restart_count
+        if quantity is Quantity.ControlLabberState and not self.worker_alive:
+            return AMI430_visa.LabberState.ERROR.name
         try:
-            value = self.dict_values_labber_thread_copy[quantity]
+            value = self._get_published(quantity=quantity)
         except KeyError:
-            # Not all values are stored in the dictionary.
+            # Not published or too old.
             # In this case we have to use the synchronized call.
             value = self.get_quantity_sync(quantity=quantity)
         if isinstance(value, enum.Enum):
             return value.value
         return value
 
-    @synchronized
+    def begin_get_group_sync(self) -> None:
+        """
+        Called by labber GUI for the first get of a call group:
+        All status quantities of the group are answered from one coherent snapshot.
+        """
+        snapshot = self._visa_station.published_snapshot
+        if snapshot is None or snapshot.age_s > self._visa_station.status_max_age_s:
+            snapshot = self._take_snapshot_sync()
+        self._group_snapshot = snapshot
+
+    def end_get_group(self) -> None:
+        "Called by labber GUI after the last get of a call group."
+        self._group_snapshot = None
+
+    @synchronized_read
+    def _take_snapshot_sync(self) -> AMI430_visa.StationSnapshot:
+        with self._visa_station.tick_scope():
+            return self._visa_station.take_snapshot()
+
+    def _get_published(self, quantity: Quantity):
+        """
+        No lock: The visa thread replaces the snapshot but never modifies it.
+        Raises KeyError if the quantity is not published or the snapshot is too old.
+        """
+        snapshot = self._group_snapshot
+        if snapshot is not None:
+            return snapshot.get_quantity(quantity=quantity)
+        snapshot = self._visa_station.published_snapshot
+        if snapshot is None or snapshot.age_s > self._visa_station.status_max_age_s:
+            raise KeyError(quantity)
+        return snapshot.get_quantity(quantity=quantity)
+
     def get_quantity_sync(self, quantity: Quantity):
+        if quantity in QUANTITIES_IMMUTABLE:
+            return self._visa_station.get_quantity(quantity=quantity)
+        return self._get_quantity_sync(quantity=quantity)
+
+    @synchronized_read
+    def _get_quantity_sync(self, quantity: Quantity):
         return self._visa_station.get_quantity(quantity=quantity)
 
-    @synchronized
+    @synchronized_write
     def signal(self, signal):
         self._visa_station.signal(signal)
 
-    @synchronized
+    @synchronized_write
     def expect_state(self, expected_meth):
         self._visa_station.expect_state(expected_meth=expected_meth)
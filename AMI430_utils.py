@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Callable, Optional
+from typing import Callable, Optional, Sequence, Tuple, Union
 import enum
 
 
@@ -12,6 +12,29 @@ def check_smaller_than(value: float, limit: float, msg: str) -> None:
         raise FieldLimitViolation(f"{value} > {limit}: {msg}")
 
 
+def segmented_ramp_duration_s(
+    start_T: float, target_T: float, segments_Tpers: Sequence[Tuple[float, float]]
+) -> float:
+    """
+    Ramp time from 'start_T' to 'target_T' with 'Magnet.ramp_rate_segments_Tpers':
+    The rate of the segment containing abs(field) applies.
+    """
+    low_T, high_T = sorted((start_T, target_T))
+    bounds_T = {0.0}
+    for upper_T, _ in segments_Tpers:
+        bounds_T.update((upper_T, -upper_T))
+    points_T = sorted({low_T, high_T} | {b for b in bounds_T if low_T < b < high_T})
+    duration_s = 0.0
+    for begin_T, end_T in zip(points_T[:-1], points_T[1:]):
+        middle_T = abs(begin_T + end_T) / 2.0
+        rate_Tpers = next(
+            (rate for upper_T, rate in segments_Tpers if middle_T <= upper_T),
+            segments_Tpers[-1][1],
+        )
+        duration_s += (end_T - begin_T) / rate_Tpers
+    return duration_s
+
+
 class Axis(enum.IntEnum):
     AXIS2 = 2
     AXIS3 = 3
@@ -38,6 +61,12 @@ class Magnet:
     switchheater_cool_time_s: float = None
     switchheater_current_A: float = None
     persisten_current_rampe_rate_Apers: float = None
+    ramp_rate_segments_Tpers: Optional[Tuple[Tuple[float, float], ...]] = None
+    """
+    Field dependent ramp rate: (upper field T, rate T/s) per segment, by increasing field.
+    Programmed into the ramp rate table of the supply: The segment containing abs(field) applies.
+    None: One segment at 'Control / Ramp Rate'.
+    """
 
     @property
     def coil_constant_TperA(self) -> float:
@@ -64,6 +93,26 @@ class Magnet:
             assert isinstance(self.switchheater_cool_time_s, float)
             assert isinstance(self.switchheater_current_A, float)
             assert isinstance(self.persisten_current_rampe_rate_Apers, float)
+        if self.ramp_rate_segments_Tpers is not None:
+            uppers_T = [upper_T for upper_T, _ in self.ramp_rate_segments_Tpers]
+            assert len(uppers_T) > 0
+            assert uppers_T == sorted(set(uppers_T)), "Segments by increasing field"
+            assert uppers_T[-1] >= self.field_limit_T, "Segments up to the field limit"
+            for _, rate_Tpers in self.ramp_rate_segments_Tpers:
+                assert 0.0 < rate_Tpers <= self.max_rampr_rate_Tpers
+
+
+@dataclass(frozen=True)
+class VisaReplay:
+    """
+    Replay a recorded session instead of talking to the supplies, see 'AMI430_recorder'.
+    """
+
+    filename: str
+    time_compression: float = 1.0
+    """
+    1.0: Original timing. 10.0: The session is replayed 10 times faster.
+    """
 
 
 @dataclass(frozen=True)
@@ -73,7 +122,20 @@ class Station:
     z_axis: Magnet
     y_axis: Magnet
     x_axis: Optional[Magnet] = None
-    use_visa_simulation: bool = False
+    use_visa_simulation: Union[bool, VisaReplay] = False
+    use_asyncio_socket: bool = False
+    """
+    Talk to 'TCPIP0::...::SOCKET' supplies using 'AMI430_socket' instead of pyvisa.
+    """
+    visa_recording_filename: Optional[str] = None
+    """
+    Append all SCPI traffic to this file, see 'AMI430_recorder'.
+    """
+    ramp_history_filename: Optional[str] = None
+    """
+    Append the completed ramps to this file, see 'AMI430_history'.
+    None: 'tmp_AMI430_<name>_ramps.jsonl' in 'AMI430_visa.DIRECTORY_TMP'.
+    """
 
     @property
     def axis(self) -> Axis:
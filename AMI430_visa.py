@@ -1,15 +1,28 @@
-from decimal import DivisionByZero
 import pathlib
 import logging
 import time
 import enum
-from typing import Any, Set, List, Optional
+import math
+import threading
+import contextlib
+import itertools
+import concurrent.futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Set, List, Optional, Sequence, Tuple, Union
 import os
 from xmlrpc.client import Boolean
 import pyvisa
 import pyvisa.resources
 
-from AMI430_utils import Station, Magnet, Axis
+from AMI430_utils import Station, Magnet, Axis, VisaReplay, FieldLimitViolation
+from AMI430_utils import segmented_ramp_duration_s
+from AMI430_socket import AMI430SocketResource, parse_socket_address
+from AMI430_metrics import VisaMetrics, command_verb
+from AMI430_recorder import ScpiRecorder, ScpiReplaySession, ScpiReplayResource
+from AMI430_history import RampHistory, RampRecord
+import AMI430_planner
 from AMI430_driver_utils import EnumLogging, EnumMixin
 from AMI430_driver_utils import Quantity
 
@@ -17,10 +30,71 @@ logger = logging.getLogger("LabberDriver")
 
 DIRECTORY_OF_THIS_FILE = pathlib.Path(__file__).parent
 FILENAME_VISA_SIM = DIRECTORY_OF_THIS_FILE / "AMI430_simulation.yaml"
+DIRECTORY_TMP = DIRECTORY_OF_THIS_FILE
+"The log file and the default ramp history: 'tmp_AMI430_*'"
 assert FILENAME_VISA_SIM.exists()
 
 _VISA_TERMINATOR = "\n"
 
+STATUS_MAX_AGE_S = 3.0
+"Default of 'Control / Status Max Age'"
+FIELD_UNCHANGED_T = 1e-4
+"The measured 'FIELD:MAG?' never equals the target: Closer counts as reached"
+
+TICK_INTERVAL_MIN_S = 0.1
+"A transition is imminent"
+TICK_INTERVAL_MAX_S = 5.0
+"A transition is far: For example the switch heater cooling for 600s"
+TICK_INTERVAL_IDLE_S = 2.0
+"Not ramping"
+TICK_INTERVAL_OVERDUE_MAX_S = 0.5
+"A transition is overdue: The estimate was wrong, poll at the former fixed interval"
+
+VECTOR_RATE_MIN_TPERS = 1e-5
+"A smaller rate is not representable in 'CONF:RAMP:RATE:FIELD'"
+
+ABORT_DEADLINE_S = 2.0
+"An abort returns after this time even if not all supplies confirmed PAUSE"
+
+SETPOINT_LIST_COLUMNS = ("X", "Y", "Z", "dwell")
+"'Control / Setpoint List': One row per point, flattened"
+
+_SNAPSHOT_QUERIES = ("STATE?", "FIELD:MAG?", "PS?", "CURR:MAG?", "QU?")
+
+_CONF_READBACK = {
+    # CONF command: (query to read back the register, number of leading arguments addressing the register)
+    "CONF:FIELD:UNITS": ("FIELD:UNITS?", 0),
+    "CONF:RAMP:RATE:UNITS": ("RAMP:RATE:UNITS?", 0),
+    "CONF:COIL": ("COIL?", 0),
+    "CONF:CURR:LIMIT": ("CURR:LIMIT?", 0),
+    "CONF:IND": ("IND?", 0),
+    "CONF:STAB": ("STAB?", 0),
+    "CONF:RAMP:RATE:SEG": ("RAMP:RATE:SEG?", 0),
+    "CONF:RAMP:RATE:FIELD": ("RAMP:RATE:FIELD:{}?", 1),
+    "CONF:FIELD:TARG": ("FIELD:TARG?", 0),
+    "CONF:PS": ("PS:INST?", 0),
+    "CONF:PS:HTIME": ("PS:HTIME?", 0),
+    "CONF:PS:CTIME": ("PS:CTIME?", 0),
+    "CONF:PS:CURR": ("PS:CURR?", 0),
+    "CONF:PS:PSRR": ("PS:PSRR?", 0),
+}
+
+
+class VisaMagnetException(Exception):
+    """
+    An exception raised while talking to the supply of magnet 'magnet_name'.
+    """
+
+    def __init__(self, magnet_name: str, msg: str):
+        super().__init__(f"Magnet {magnet_name}: {msg}")
+        self.magnet_name = magnet_name
+
+
+class RampTimeoutException(Exception):
+    """
+    A magnet did not reach the expected state in time: The ramp failed.
+    """
+
 
 class LoggerTags(EnumMixin, enum.Enum):
     MAGNET_FIELD = enum.auto()
@@ -31,6 +105,12 @@ class LoggerTags(EnumMixin, enum.Enum):
     LABBER_SET = enum.auto()
     STATION_RAMPING_STATE = enum.auto()
     RAMPING_DURATION_S = enum.auto()
+    VISA_OPEN_DURATION_S = enum.auto()
+    VISA_LATENCY = enum.auto()
+    ABORT_LATENCY_S = enum.auto()
+    VECTOR_RAMP_S = enum.auto()
+    RAMP_PLAN = enum.auto()
+    SETPOINT_LIST = enum.auto()
 
     @classmethod
     def general_properties(cls) -> Set["LoggerTags"]:
@@ -94,6 +174,15 @@ class ControlMode(EnumMixin, enum.Enum):
     RAMPING_WAIT = 1
 
 
+class RampMode(EnumMixin, enum.Enum):
+    # ATTENTION: These values HAVE TO correspond with the
+    # values in AMI430_driver.ini, but -1
+    SEQUENTIAL = 0
+    SIMULTANEOUS = 1
+    VECTOR = 2
+    PLANNED = 3
+
+
 class MagnetRampingState(enum.Enum):
     INIT = 1
     WAITFOR_CURRENT = 2
@@ -102,101 +191,334 @@ class MagnetRampingState(enum.Enum):
     WAITFOR_SWITCH_COLD = 5
     WAITFOR_ZERO_CURRENT = 6
     DONE = 7
+    ARMED = 8
+
+
+@dataclass(frozen=True)
+class MagnetSnapshot:
+    """
+    Status of one magnet as read by 'VisaMagnet.snapshot()' in one pipelined exchange.
+    """
+
+    name: str
+    time_s: float
+    state: AMI430State
+    field_T: float
+    switchheater_state: int
+    current_magnet_A: float
+    quench_state: int
+
+    @property
+    def age_s(self) -> float:
+        return time.time() - self.time_s
+
+
+@dataclass(frozen=True)
+class StationSnapshot:
+    """
+    Status of the station, published by the visa thread after every tick.
+    Immutable: The labber thread reads it without taking the lock.
+    """
+
+    time_s: float
+    magnets: Dict[str, MagnetSnapshot]
+    labber_state: LabberState
+    switchheater_state: int
+    ramp_eta_s: float = 0.0
+    ramp_progress_percent: float = 100.0
+    setpoint_list_index: int = -1
+    setpoint_list_arrivals_s: Tuple[float, ...] = ()
+
+    @property
+    def age_s(self) -> float:
+        return time.time() - self.time_s
+
+    def get_quantity(self, quantity: Quantity) -> Any:
+        """
+        Raises KeyError if the quantity is not covered by the snapshot.
+        """
+        if quantity is Quantity.ControlLabberState:
+            return self.labber_state.name
+        if quantity is Quantity.StatusSwitchheaterStatus:
+            return self.switchheater_state
+        if quantity is Quantity.StatusSnapshotAge:
+            return self.age_s
+        if quantity is Quantity.StatusRampEta:
+            return self.ramp_eta_s
+        if quantity is Quantity.StatusRampProgress:
+            return self.ramp_progress_percent
+        if quantity is Quantity.StatusSetpointListIndex:
+            return self.setpoint_list_index
+        if quantity is Quantity.StatusSetpointListArrivals:
+            return list(self.setpoint_list_arrivals_s)
+        name = _QUANTITY_MAGNET_STATE.get(quantity, None)
+        if name is not None:
+            return self.magnets[name].state.name
+        return self.magnets[_QUANTITY_MAGNET_FIELD_ACTUAL[quantity]].field_T
+
+
+_QUANTITY_MAGNET_STATE = {
+    Quantity.StatusMagnetStateX: "X",
+    Quantity.StatusMagnetStateY: "Y",
+    Quantity.StatusMagnetStateZ: "Z",
+}
+_QUANTITY_MAGNET_FIELD_ACTUAL = {
+    Quantity.StatusFieldActualX: "X",
+    Quantity.StatusFieldActualY: "Y",
+    Quantity.StatusFieldActualZ: "Z",
+}
+
+
+def vector_ramp_rates(
+    distance_T: Dict[str, float], rate_max_Tpers: Dict[str, float]
+) -> Tuple[float, Dict[str, float]]:
+    """
+    Ramp rates for a straight line: Every magnet arrives after the same duration.
+    The slowest magnet ramps at its maximal rate, the others slower.
+    Returns (duration_s, magnet name -> rate).
+    """
+    duration_s = max(
+        abs(distance_T[name]) / rate_max_Tpers[name] for name in distance_T
+    )
+    rates_Tpers = {}
+    for name, distance in distance_T.items():
+        if duration_s <= 0.0:
+            rates_Tpers[name] = rate_max_Tpers[name]
+            continue
+        rates_Tpers[name] = max(abs(distance) / duration_s, VECTOR_RATE_MIN_TPERS)
+    return duration_s, rates_Tpers
+
+
+@dataclass(frozen=True)
+class SetpointListPoint:
+    field_T: Dict[str, float]
+    "Magnet name -> field"
+    dwell_s: float
+    "Time to stay at this point after arrival"
+
+
+def parse_setpoint_list(
+    value: Any, magnet_names: Sequence[str]
+) -> List[SetpointListPoint]:
+    """
+    'value': Labber vector (or trace dict) with the rows of SETPOINT_LIST_COLUMNS, flattened.
+    The X column is ignored by a station without X axis.
+    """
+    if isinstance(value, dict):
+        value = value["y"]
+    values = [float(v) for v in value]
+    columns = len(SETPOINT_LIST_COLUMNS)
+    if len(values) % columns != 0:
+        raise ValueError(
+            f"Setpoint list: {len(values)} values is not a multiple of {SETPOINT_LIST_COLUMNS}"
+        )
+    points = []
+    for i in range(0, len(values), columns):
+        row = dict(zip(SETPOINT_LIST_COLUMNS, values[i : i + columns]))
+        if row["dwell"] < 0.0:
+            raise ValueError(f"Setpoint list point {len(points)}: Negative dwell time")
+        points.append(
+            SetpointListPoint(
+                field_T={name: row[name] for name in magnet_names},
+                dwell_s=row["dwell"],
+            )
+        )
+    return points
+
+
+def ramp_skip_reason(
+    magnet: Magnet,
+    snapshot: MagnetSnapshot,
+    holding_current: bool,
+    holding_switchheater_on: bool,
+) -> Optional[str]:
+    """
+    The field is already at the setpoint: May the ramp be skipped?
+    Returns the reason to skip or None if the switch heater or current has to change.
+    """
+    if not magnet.has_switchheater:
+        if snapshot.state == AMI430State.HOLDING:
+            return "Field already at setpoint"
+        return None
+    if holding_current:
+        if holding_switchheater_on:
+            if snapshot.switchheater_state:
+                return "Field already at setpoint with switch warm and holding current"
+            return None
+        if not snapshot.switchheater_state:
+            return "Field already at setpoint with switch cold"
+        return None
+    if snapshot.switchheater_state:
+        return None
+    if snapshot.state == AMI430State.AT_ZERO_CURRENT:
+        return "Field already at setpoint with switch cold and zero current"
+    return None
+
+
+def ramp_phases(
+    magnet: Magnet,
+    switchheater_warm: bool,
+    vector: bool,
+    holding_switchheater_on: bool,
+    holding_current: bool,
+) -> List[MagnetRampingState]:
+    """
+    The states 'RampingStatemachineMagnet' passes, in order.
+    """
+    phases = [MagnetRampingState.INIT]
+    if magnet.has_switchheater and not switchheater_warm:
+        phases.extend(
+            (MagnetRampingState.WAITFOR_CURRENT, MagnetRampingState.WAITFOR_SWITCH_WARM)
+        )
+    if vector:
+        phases.append(MagnetRampingState.ARMED)
+    phases.append(MagnetRampingState.WAITFOR_HOLDING)
+    if magnet.has_switchheater and not holding_switchheater_on:
+        phases.append(MagnetRampingState.WAITFOR_SWITCH_COLD)
+        if not holding_current:
+            phases.append(MagnetRampingState.WAITFOR_ZERO_CURRENT)
+    return phases
+
+
+def predict_phase_s(
+    visa_magnet: "VisaMagnet",
+    phase: MagnetRampingState,
+    start_T: float,
+    target_T: float,
+    rate_Tpers: float,
+    segments_Tpers: Optional[Sequence[Tuple[float, float]]] = None,
+) -> float:
+    """
+    The time 'visa_magnet' is expected to spend in 'phase':
+    Learned from the ramp history, else from the magnet configuration.
+    'segments_Tpers': The ramp rate table if programmed, see 'VisaMagnet.ramp_segments_Tpers'.
+    """
+    history = visa_magnet.visa_station.ramp_history
+    magnet = visa_magnet.magnet
+    if phase in (MagnetRampingState.INIT, MagnetRampingState.ARMED):
+        # Immediate or waiting for the other magnets
+        return 0.0
+    if phase is MagnetRampingState.WAITFOR_HOLDING:
+        duration_s = visa_magnet.expected_ramp_duration_s(
+            start_T=start_T,
+            target_T=target_T,
+            rate_Tpers=rate_Tpers,
+            segments_Tpers=segments_Tpers,
+        ) + history.ramp_overhead_s(visa_magnet.name, phase.name)
+        return max(duration_s, 0.0)
+    learned_s = history.phase_s(visa_magnet.name, phase.name)
+    if learned_s is not None:
+        return learned_s
+    if phase is MagnetRampingState.WAITFOR_SWITCH_WARM:
+        return magnet.switchheater_heat_time_s
+    if phase is MagnetRampingState.WAITFOR_SWITCH_COLD:
+        return magnet.switchheater_cool_time_s
+    # WAITFOR_CURRENT, WAITFOR_ZERO_CURRENT
+    return magnet.expected_current_ramptime_cold_switch_s
 
 
 class RampingStatemachineMagnet:
-    def __init__(self, visa_magnet: "VisaMagnet"):
+    def __init__(
+        self,
+        visa_magnet: "VisaMagnet",
+        vector: bool = False,
+        target_T: Optional[float] = None,
+        final: bool = True,
+        lazy_cooling: bool = False,
+        prewarm: bool = False,
+    ):
         self._visa_magnet = visa_magnet
+        self._vector = vector
+        "Do not ramp but wait in state ARMED: The station starts all magnets at once."
+        self._prewarm = prewarm
+        "Warm the switch heater but wait in state ARMED till 'release()'"
+        self.target_T = (
+            visa_magnet.field_setpoint_Tesla if target_T is None else target_T
+        )
+        "The setpoint or a waypoint"
+        self._final = final
+        "False for a waypoint: Keep switch heater and current on"
+        self._lazy_cooling = lazy_cooling
+        "Keep switch heater and current on: The station cools the switch later"
+        self.holding_s: Optional[float] = None
+        "When HOLDING was reached"
+        self._start_T: Optional[float] = None
+        "The field when the ramp was configured. None: Not configured yet"
+        self._rate_Tpers = visa_magnet.field_ramp_TeslaPers
+        self._segments_Tpers = None if vector else visa_magnet.ramp_segments_Tpers
+        "The ramp rate table, None for a single segment at '_rate_Tpers'"
+        self._switchheater_warm: Optional[bool] = None
+        "The switch heater was already warm at start. None: Not started yet"
+        self._switchheater_switches = 0
+        self.phases_s: Dict[str, float] = {}
+        "MagnetRampingState name -> time spent in this state, see 'RampRecord'"
+        self._state_since_s = time.time()
         self._state: MagnetRampingState = MagnetRampingState.INIT
         self._timeout = time.time()
+        self._transition_expected_s = time.time()
+        "When the state is expected to change: Used to schedule the next tick"
 
         logger.debug(
             self.prefix(
-                f"Magnet {self._visa_magnet.name}: Start ramping to {self._visa_magnet.field_setpoint_Tesla} T"
+                f"Magnet {self._visa_magnet.name}: Start ramping to {self.target_T} T"
             )
         )
         if self._visa_magnet.field_actual_Tesla is not None:
-            if (
-                abs(
-                    self._visa_magnet.field_setpoint_Tesla
-                    - self._visa_magnet.field_actual_Tesla
-                )
-                < 1e-12
-            ):
-                # if self._visa_magnet.visa_state == AMI430State.HOLDING:
-                #     logger.info(self.prefix("Field already at setpoint: Skip ramp"))
-                #     self._state = MagnetRampingState.DONE
-                #     return
-                # if self._visa_magnet.magnet.has_switchheater:
-
-                #     if self._visa_magnet.visa_station.holding_current:
-                #         logger.info(
-                #             self.prefix(
-                #                 "Field already at setpoint with switch warm and holding current: Skip ramp"
-                #             )
-                #         )
-                #         self._state = MagnetRampingState.DONE
-                #         return
-                #     if not self._visa_magnet.visa_station.holding_switchheater_on:
-                #         if self._visa_magnet.visa_state == AMI430State.AT_ZERO_CURRENT:
-                #             logger.info(
-                #                 self.prefix(
-                #                     "Field already at setpoint with cold switch: Skip ramp"
-                #                 )
-                #             )
-                #             self._state = MagnetRampingState.DONE
-                #             return
-                logger.info(f"The setpoint is {self._visa_magnet.field_setpoint_Tesla}")
+            if abs(self.target_T - self._visa_magnet.field_actual_Tesla) < 1e-12:
+                logger.info(f"The setpoint is {self.target_T}")
                 logger.info(
                     f"The actual field is {self._visa_magnet.field_actual_Tesla}"
                 )
-                if self._visa_magnet.magnet.has_switchheater:
-                    if self._visa_magnet.visa_station.holding_current:
-                        if self._visa_magnet.visa_station.holding_switchheater_on:
-                            if self._visa_magnet.switchheater_state:
-                                self._state = MagnetRampingState.DONE
-                                logger.info(
-                                    self.prefix(
-                                        "Field already at setpoint with switch warm and holding current: Skip ramp"
-                                    )
-                                )
-                        else:  # return
-                            if not self._visa_magnet.switchheater_state:
-                                self._state = MagnetRampingState.DONE
-                                logger.info(
-                                    self.prefix(
-                                        "Field already at setpoint with switch cold: Skip ramp"
-                                    )
-                                )
-                                # return
-                    if not self._visa_magnet.visa_station.holding_current:
-                        if not self._visa_magnet.switchheater_state:
-                            logger.info(
-                                self.prefix("We are checking if at zero current is ok")
-                            )
-                            if (
-                                self._visa_magnet.visa_state
-                                == AMI430State.AT_ZERO_CURRENT
-                            ):
-                                self._state = MagnetRampingState.DONE
-                                logger.info(
-                                    self.prefix(
-                                        "Field already at setpoint with switch cold and zero current: Skip ramp"
-                                    )
-                                )
-                                # return
-                else:
-                    if self._visa_magnet.visa_state == AMI430State.HOLDING:
-                        logger.info(self.prefix("Field already at setpoint: Skip ramp"))
-                        self._state = MagnetRampingState.DONE
-                        # return
-        # return
+                reason = ramp_skip_reason(
+                    magnet=self._visa_magnet.magnet,
+                    snapshot=self._visa_magnet.snapshot(),
+                    holding_current=self._holding_current,
+                    holding_switchheater_on=self._holding_switchheater_on,
+                )
+                if reason is not None:
+                    logger.info(self.prefix(f"{reason}: Skip ramp"))
+                    self._state = MagnetRampingState.DONE
 
         # self._visa_magnet.ensure_switch_on()
 
+    @property
+    def _holding_current(self) -> bool:
+        return (
+            self._visa_magnet.visa_station.holding_current
+            or not self._final
+            or self._lazy_cooling
+        )
+
+    @property
+    def _holding_switchheater_on(self) -> bool:
+        return (
+            self._visa_magnet.visa_station.holding_switchheater_on
+            or not self._final
+            or self._lazy_cooling
+        )
+
     def is_done(self):
         return self._state == MagnetRampingState.DONE
 
+    @property
+    def armed(self) -> bool:
+        return self._state == MagnetRampingState.ARMED
+
+    def configure_vector_ramp(self, field_ramp_TeslaPers: float) -> None:
+        "Called by the station for all armed magnets before the RAMP burst."
+        assert self.armed
+        self._configure_ramp(self._visa_magnet.snapshot(), field_ramp_TeslaPers)
+
+    def release(self) -> None:
+        "Called by the station when it is the turn of a prewarmed magnet."
+        self._prewarm = False
+
+    def vector_ramp_started(self) -> None:
+        "Called by the station after the RAMP burst."
+        assert self.armed
+        self._phase_done(self._state)
+        self._state = MagnetRampingState.WAITFOR_HOLDING
+
     def prefix(self, msg) -> str:
         return self._visa_magnet.prefix(msg)
 
@@ -204,46 +526,182 @@ class RampingStatemachineMagnet:
     def magnet(self) -> "Magnet":
         return self._visa_magnet.magnet
 
+    @property
+    def visa_magnet(self) -> "VisaMagnet":
+        return self._visa_magnet
+
     @property
     def statetext(self) -> str:
         return f"{self._visa_magnet.name}-{self._state.name}"
 
+    def _expect_transition(self, duration_s: float) -> None:
+        self._transition_expected_s = time.time() + duration_s
+
+    def next_tick_interval_s(self) -> float:
+        """
+        Poll slowly while the expected transition is far, fast when it is near or overdue.
+        """
+        if self._state == MagnetRampingState.DONE:
+            return TICK_INTERVAL_MIN_S
+        if self._state == MagnetRampingState.ARMED:
+            if not self._vector and not self._prewarm:
+                # Released
+                return TICK_INTERVAL_MIN_S
+            # The other magnets decide
+            return TICK_INTERVAL_MAX_S
+        remaining_s = self._transition_expected_s - time.time()
+        if remaining_s > 0.0:
+            return min(max(remaining_s / 4.0, TICK_INTERVAL_MIN_S), TICK_INTERVAL_MAX_S)
+        return min(
+            max(-remaining_s / 10.0, TICK_INTERVAL_MIN_S), TICK_INTERVAL_OVERDUE_MAX_S
+        )
+
+    def _phase_done(self, state: MagnetRampingState) -> None:
+        "Account the time spent in 'state' which was just left."
+        now_s = time.time()
+        self.phases_s[state.name] = (
+            self.phases_s.get(state.name, 0.0) + now_s - self._state_since_s
+        )
+        self._state_since_s = now_s
+
+    @property
+    def _effective_rate_Tpers(self) -> float:
+        "With a ramp rate table: The average rate of this ramp."
+        if self._segments_Tpers is None or self._start_T == self.target_T:
+            return self._rate_Tpers
+        duration_s = segmented_ramp_duration_s(
+            self._start_T, self.target_T, self._segments_Tpers
+        )
+        return abs(self.target_T - self._start_T) / duration_s
+
+    def _record_ramp(self) -> None:
+        phases_s = dict(self.phases_s)
+        if self._switchheater_warm:
+            # Not heated: Would spoil the learned heat time
+            phases_s.pop(MagnetRampingState.WAITFOR_SWITCH_WARM.name, None)
+        self._visa_magnet.visa_station.ramp_history.append(
+            RampRecord(
+                magnet=self._visa_magnet.name,
+                time_s=time.time(),
+                from_T=self._start_T,
+                to_T=self.target_T,
+                rate_Tpers=self._effective_rate_Tpers,
+                phases_s=phases_s,
+                switchheater_switches=self._switchheater_switches,
+            )
+        )
+
+    def remaining_s(self) -> float:
+        """
+        The predicted time till DONE, see 'predict_phase_s()'.
+        """
+        if self._state == MagnetRampingState.DONE:
+            return 0.0
+        snapshot = self._visa_magnet.snapshot()
+        switchheater_warm = self._switchheater_warm
+        if switchheater_warm is None:
+            switchheater_warm = bool(snapshot.switchheater_state)
+        start_T = snapshot.field_T if self._start_T is None else self._start_T
+        phases = ramp_phases(
+            magnet=self.magnet,
+            switchheater_warm=switchheater_warm,
+            vector=self._vector,
+            holding_switchheater_on=self._holding_switchheater_on,
+            holding_current=self._holding_current,
+        )
+        remaining_s = 0.0
+        for phase in phases:
+            if phase.name in self.phases_s:
+                # Already passed
+                continue
+            phase_s = predict_phase_s(
+                visa_magnet=self._visa_magnet,
+                phase=phase,
+                start_T=start_T,
+                target_T=self.target_T,
+                rate_Tpers=self._rate_Tpers,
+                segments_Tpers=self._segments_Tpers,
+            )
+            if phase == self._state:
+                phase_s = max(phase_s - (time.time() - self._state_since_s), 0.0)
+            remaining_s += phase_s
+        return remaining_s
+
     def tick(self):
         state_before = self._state
         self._tick()
         state_after = self._state
         if state_before != state_after:
+            self._phase_done(state_before)
             logger.debug(
                 self.prefix(
                     f"{state_before.name} -> {state_after.name}, timeout {self._timeout - time.time():0.1f} s"
                 )
             )
+            if state_after == MagnetRampingState.DONE and self._start_T is not None:
+                self._record_ramp()
 
-    def _tick(self):
-        def start_ramping():
+    def _configure_ramp(
+        self, snapshot: MagnetSnapshot, field_ramp_TeslaPers: float
+    ) -> None:
+        confs = self._visa_magnet.ramp_rate_confs(
+            rate_Tpers=field_ramp_TeslaPers, segments_Tpers=self._segments_Tpers
+        )
+        confs.append(("CONF:FIELD:TARG", self.target_T))
+        conf_unchanged = all(self._visa_magnet.conf_matches(*conf) for conf in confs)
+        if not conf_unchanged and snapshot.state != AMI430State.PAUSED:
             self._visa_magnet.write_raw("PAUSE")
-            self._visa_magnet.visa_state
-            logger.info(self.prefix("Field Ramp"))
-            # self._visa_magnet.write_raw("CONF:RAMP:RATE:SEG 1")
-            self._visa_magnet.write_raw(
-                f"CONF:RAMP:RATE:FIELD 1,{self._visa_magnet.field_ramp_TeslaPers:f},0"
+        logger.info(self.prefix("Field Ramp"))
+        for conf in confs:
+            self._visa_magnet.write_conf(*conf)
+        self._start_T = snapshot.field_T
+        self._rate_Tpers = field_ramp_TeslaPers
+        self._expect_transition(
+            predict_phase_s(
+                visa_magnet=self._visa_magnet,
+                phase=MagnetRampingState.WAITFOR_HOLDING,
+                start_T=self._start_T,
+                target_T=self.target_T,
+                rate_Tpers=self._rate_Tpers,
+                segments_Tpers=self._segments_Tpers,
             )
-            self._visa_magnet.write_raw(
-                f"CONF:FIELD:TARG {self._visa_magnet.field_setpoint_Tesla:f}"
-            )
-            time.time() + self._visa_magnet.expected_ramp_duration_s * 1.5
+        )
 
-            self._visa_magnet.write_raw("RAMP")
+    def _start_ramping(self, snapshot: MagnetSnapshot) -> None:
+        if self._vector or self._prewarm:
+            if snapshot.state != AMI430State.PAUSED:
+                self._visa_magnet.write_raw("PAUSE")
+            logger.info(self.prefix("Armed: Waiting for the other magnets"))
+            self._state = MagnetRampingState.ARMED
+            return
+        self._configure_ramp(snapshot, self._visa_magnet.field_ramp_TeslaPers)
+        self._visa_magnet.write_raw("RAMP")
+        self._state = MagnetRampingState.WAITFOR_HOLDING
+
+    def _tick(self):
+        if self._state == MagnetRampingState.DONE:
+            return
+        if self._state == MagnetRampingState.ARMED:
+            if self._vector or self._prewarm:
+                return
+
+        snapshot = self._visa_magnet.snapshot()
+
+        if self._state == MagnetRampingState.ARMED:
+            # Prewarmed and released
+            self._start_ramping(snapshot)
+            return
 
         if self._state == MagnetRampingState.INIT:
+            self._switchheater_warm = bool(snapshot.switchheater_state)
             if not self.magnet.has_switchheater:
-                start_ramping()
-                self._state = MagnetRampingState.WAITFOR_HOLDING
+                self._start_ramping(snapshot)
                 return
 
-            if self._visa_magnet.ask_raw("PS?", astype=int) == 1:
+            if snapshot.switchheater_state == 1:
                 # this assumes that the switch is already heated we neglect to wait for swith to warm and directly set the paused state
                 self._visa_magnet.write_raw("PAUSE")
+                self._expect_transition(0.0)
                 self._state = MagnetRampingState.WAITFOR_SWITCH_WARM
                 return
 
@@ -252,88 +710,83 @@ class RampingStatemachineMagnet:
             self._timeout = (
                 time.time() + self.magnet.expected_current_ramptime_cold_switch_s * 1.5
             )
-            logger.info(
-                f"{LoggerTags.MAGNET_STATE.name} {self._visa_magnet.name} {self._visa_magnet.visa_state.name} {self._visa_magnet.visa_state.value}"
-            )
+            self._expect_transition(self.magnet.expected_current_ramptime_cold_switch_s)
 
             self._state = MagnetRampingState.WAITFOR_CURRENT
             return
 
         if self._state == MagnetRampingState.WAITFOR_CURRENT:
-            if self._visa_magnet.visa_state == AMI430State.HOLDING:
+            if snapshot.state == AMI430State.HOLDING:
                 self._visa_magnet.write_raw(
                     "PS 1"
                 )  # Persistent switch heater ON (heat up)
+                self._switchheater_switches += 1
                 self._timeout = (
                     time.time() + self.magnet.switchheater_heat_time_s + 10.0
                 )
+                self._expect_transition(self.magnet.switchheater_heat_time_s)
                 self._state = MagnetRampingState.WAITFOR_SWITCH_WARM
                 return
             return
 
         if self._state == MagnetRampingState.WAITFOR_SWITCH_WARM:
-            if self._visa_magnet.visa_state == AMI430State.PAUSED:
-                start_ramping()
-                self._state = MagnetRampingState.WAITFOR_HOLDING
+            if snapshot.state == AMI430State.PAUSED:
+                self._start_ramping(snapshot)
                 return
             return
 
         if self._state == MagnetRampingState.WAITFOR_HOLDING:
-            if self._visa_magnet.visa_state == AMI430State.HOLDING:
-                self._visa_magnet.field_actual_Tesla = (
-                    self._visa_magnet.field_setpoint_Tesla
-                )
+            if snapshot.state == AMI430State.HOLDING:
+                self.holding_s = time.time()
+                self._visa_magnet.field_actual_Tesla = self.target_T
                 if not self.magnet.has_switchheater:
                     self._state = MagnetRampingState.DONE
                     return
-                if self._visa_magnet.visa_station.holding_switchheater_on:
+                if self._holding_switchheater_on:
                     self._state = MagnetRampingState.DONE
                     return
                 logger.info(self.prefix("Persistent switch cooling"))
                 self._visa_magnet.write_raw(
                     "PS 0"
                 )  # Persistent switch heater OFF (cool down)
+                self._switchheater_switches += 1
                 self._timeout = (
                     time.time() + self.magnet.switchheater_cool_time_s + 10.0
                 )
+                self._expect_transition(self.magnet.switchheater_cool_time_s)
                 self._state = MagnetRampingState.WAITFOR_SWITCH_COLD
             return
 
         if self._state == MagnetRampingState.WAITFOR_SWITCH_COLD:
-            if (
-                self._visa_magnet.visa_state == AMI430State.PAUSED
-            ):  # changed to PAUSED from HOLDING
-                if self._visa_magnet.visa_station.holding_current:
+            if snapshot.state == AMI430State.PAUSED:  # changed to PAUSED from HOLDING
+                if self._holding_current:
                     self._state = MagnetRampingState.DONE
                     return
 
                 logger.info(self.prefix("Current zeroing"))
 
                 self._visa_magnet.write_raw("ZERO")
-                logger.info(
-                    f"{LoggerTags.MAGNET_STATE.name} {self._visa_magnet.name} {self._visa_magnet.visa_state.name} {self._visa_magnet.visa_state.value}"
-                )
                 self._state = MagnetRampingState.WAITFOR_ZERO_CURRENT
                 self._timeout = (
                     time.time()
                     + self.magnet.expected_current_ramptime_cold_switch_s * 1.5
                 )
+                self._expect_transition(
+                    self.magnet.expected_current_ramptime_cold_switch_s
+                )
                 return
 
             if time.time() > self._timeout:
-                raise Exception("Timeout")
+                raise RampTimeoutException(self.prefix("Timeout"))
             return
         if self._state == MagnetRampingState.WAITFOR_ZERO_CURRENT:
-            if self._visa_magnet.visa_state == AMI430State.AT_ZERO_CURRENT:
-                logger.info(
-                    f"{LoggerTags.MAGNET_STATE.name} {self._visa_magnet.name} {self._visa_magnet.visa_state.name} {self._visa_magnet.visa_state.value}"
-                )
+            if snapshot.state == AMI430State.AT_ZERO_CURRENT:
                 self._state = MagnetRampingState.DONE
                 return
             if time.time() > self._timeout:
-                raise Exception("Timeout")
+                raise RampTimeoutException(self.prefix("Timeout"))
             return
-        assert self._state == MagnetRampingState.DONE
+        assert False, self._state
 
 
 class RampingStatemachineStation:
@@ -346,54 +799,390 @@ class RampingStatemachineStation:
     - wait for status ...
     - send command: zero current
     - wait for status ...
+
+    RampMode.SIMULTANEOUS: All magnets are ramped at the same time.
+    Only if every intermediate field is within the field limit, else sequentially.
+
+    RampMode.VECTOR: All magnets are armed (switch heater warm, PAUSED).
+    Then the ramp rates are scaled for a straight line and RAMP is sent
+    to all magnets in one burst: The magnets reach HOLDING at the same time.
+
+    RampMode.PLANNED: 'AMI430_planner' chooses the fastest safe path.
+    Every leg of the path is ramped VECTOR or SEQUENTIAL in the planned order.
+    Switch heater and current are kept on till the last leg.
+
+    RampMode.SEQUENTIAL: A queued magnet with a cold switch heater is prewarmed
+    while the magnets before are ramping: Current matching and warm up do not
+    change its field. It is ramped as soon as it is its turn.
     """
 
     def __init__(self, visa_station: "VisaStation"):
         self._visa_station = visa_station
         self._magnets_to_be_ramped: List[VisaMagnet] = []
-        self._current_magnet: Optional[RampingStatemachineMagnet] = None
+        self._current_magnets: List[RampingStatemachineMagnet] = []
+        self._prewarm_magnets: Dict[str, RampingStatemachineMagnet] = {}
+        "Queued magnets warming the switch heater: Magnet name -> state machine"
+        self._ramp_mode = RampMode.SEQUENTIAL
+        "The ramp mode of the current ramp: May be SEQUENTIAL if 'VisaStation.ramp_mode' is not safe"
+        self._vector_magnets: List[RampingStatemachineMagnet] = []
+        self._vector_start_s: Optional[float] = None
+        self._vector_duration_s = 0.0
+        self._vector_sequential_s = 0.0
+        self._legs: List[AMI430_planner.Leg] = []
+        "The legs of RampMode.PLANNED still to be ramped"
+        self._leg_target_T: Dict[str, float] = {}
+        "The targets of the current leg: Empty for the setpoints"
+        self._leg_start_T: Dict[str, float] = {}
+        self._final_leg = True
+        self.lazy_cooling = False
+        "The switch heater is kept warm: See 'VisaStation.lazy_cooling'"
         self.done = True
+        self.abort_requested = False
+        "May be set without lock: The next 'tick()' will not talk to the magnets anymore"
+
+    def start_persisting(self, visa_magnet: "VisaMagnet", target_T: float) -> None:
+        """
+        Cool the switch heater kept warm by the lazy cooling policy.
+        'target_T': Where the magnet holds: An aborted ramp is not resumed.
+        """
+        self.done = False
+        self._magnets_to_be_ramped = [visa_magnet]
+        self._prewarm_magnets = {}
+        self._ramp_mode = RampMode.SEQUENTIAL
+        self._vector_start_s = None
+        self._legs = []
+        self._leg_target_T = {visa_magnet.name: target_T}
+        self._final_leg = True
+        self.lazy_cooling = False
 
     def start_ramping(self):
         "List of magnets waiting for there field to be ramped."
+        snapshots = self._visa_station.recent_snapshots()
+        plan: Optional[AMI430_planner.Plan] = None
+        if self._visa_station.ramp_mode is RampMode.PLANNED:
+            # May raise FieldLimitViolation: Before the state is changed
+            plan = self._visa_station.plan_ramp(
+                start_T={name: snapshot.field_T for name, snapshot in snapshots.items()}
+            )
         self.done = False
+        self.lazy_cooling = self._visa_station.lazy_cooling
 
         tmp_magnets = []
         for visa_magnet in self._visa_station.visa_magnets:
-            current_field_T = visa_magnet.visa_field_T
+            current_field_T = snapshots[visa_magnet.name].field_T
             set_field_T = visa_magnet.field_setpoint_Tesla
             increment_T = set_field_T - current_field_T
-            # if abs(increment_T) > 1e-6:
+            if self._visa_station.ramp_mode is not RampMode.PLANNED:
+                reason = self._skip_reason(visa_magnet, snapshots[visa_magnet.name])
+                if reason is not None:
+                    logger.info(f"Magnet {visa_magnet.name}: {reason}: Not queued")
+                    continue
             tmp_magnets.append((increment_T, visa_magnet))
-        tmp_magnets.sort()
-        for _, visa_magnet in tmp_magnets:
-            self._magnets_to_be_ramped.append(visa_magnet)
+        tmp_magnets.sort(key=lambda increment_magnet: increment_magnet[0])
+        self._magnets_to_be_ramped = [visa_magnet for _, visa_magnet in tmp_magnets]
+        self._vector_start_s = None
+        self._leg_target_T = {}
+        self._final_leg = True
+        self._prewarm_magnets = {}
+
+        if plan is not None:
+            self._leg_start_T = {
+                name: snapshot.field_T for name, snapshot in snapshots.items()
+            }
+            self._legs = list(plan.legs)
+            self._start_leg()
+            return
+        self._legs = []
+        self._ramp_mode = self._select_ramp_mode(snapshots)
+        if self._ramp_mode is RampMode.SEQUENTIAL:
+            for visa_magnet in self._magnets_to_be_ramped[1:]:
+                snapshot = snapshots[visa_magnet.name]
+                if not visa_magnet.magnet.has_switchheater:
+                    continue
+                if snapshot.switchheater_state:
+                    continue
+                if visa_magnet.field_unchanged(
+                    visa_magnet.field_setpoint_Tesla, snapshot
+                ):
+                    continue
+                self._prewarm_magnets[visa_magnet.name] = self._new_current_magnet(
+                    visa_magnet, prewarm=True
+                )
+
+    def _skip_reason(
+        self, visa_magnet: "VisaMagnet", snapshot: MagnetSnapshot
+    ) -> Optional[str]:
+        "Planned up front from a recent snapshot: Unchanged magnets cost no VISA traffic."
+        if not visa_magnet.field_unchanged(visa_magnet.field_setpoint_Tesla, snapshot):
+            return None
+        return ramp_skip_reason(
+            magnet=visa_magnet.magnet,
+            snapshot=snapshot,
+            holding_current=self._visa_station.holding_current or self.lazy_cooling,
+            holding_switchheater_on=self._visa_station.holding_switchheater_on
+            or self.lazy_cooling,
+        )
+
+    def _start_leg(self) -> None:
+        leg = self._legs.pop(0)
+        self._final_leg = len(self._legs) == 0
+        if len(self._leg_target_T) > 0:
+            self._leg_start_T = self._leg_target_T
+        self._leg_target_T = leg.target_T
+        self._ramp_mode = RampMode.VECTOR if leg.vector else RampMode.SEQUENTIAL
+        names = list(leg.order)
+        if leg.vector:
+            names = [
+                name
+                for name in sorted(leg.target_T)
+                if leg.target_T[name] != self._leg_start_T[name]
+            ]
+        if self._final_leg:
+            # All magnets: The switch heater and current are set as configured
+            names.extend(
+                visa_magnet.name
+                for visa_magnet in self._visa_station.visa_magnets
+                if visa_magnet.name not in names
+            )
+        visa_magnets = {
+            visa_magnet.name: visa_magnet
+            for visa_magnet in self._visa_station.visa_magnets
+        }
+        self._magnets_to_be_ramped = [visa_magnets[name] for name in names]
+        logger.info(
+            f"{LoggerTags.RAMP_PLAN.name} leg: {leg.text} {'final' if self._final_leg else 'waypoint'}"
+        )
+
+    def _new_current_magnet(
+        self, visa_magnet: "VisaMagnet", prewarm: bool = False
+    ) -> RampingStatemachineMagnet:
+        return RampingStatemachineMagnet(
+            visa_magnet=visa_magnet,
+            vector=self._ramp_mode is RampMode.VECTOR,
+            target_T=self._leg_target_T.get(visa_magnet.name, None),
+            final=self._final_leg,
+            lazy_cooling=self.lazy_cooling,
+            prewarm=prewarm,
+        )
+
+    def _select_ramp_mode(self, snapshots: Dict[str, MagnetSnapshot]) -> RampMode:
+        ramp_mode = self._visa_station.ramp_mode
+        if ramp_mode is RampMode.SEQUENTIAL:
+            return ramp_mode
+        start_T = {name: snapshot.field_T for name, snapshot in snapshots.items()}
+        target_T = {
+            visa_magnet.name: visa_magnet.field_setpoint_Tesla
+            for visa_magnet in self._visa_station.visa_magnets
+        }
+        if ramp_mode is RampMode.SIMULTANEOUS:
+            violation = self._visa_station.find_field_limit_violation(
+                start_T=start_T, target_T=target_T
+            )
+        else:
+            assert ramp_mode is RampMode.VECTOR
+            if any(
+                visa_magnet.field_ramp_TeslaPers <= 0.0
+                for visa_magnet in self._visa_station.visa_magnets
+            ):
+                logger.info(
+                    f"{ramp_mode.name}: Ramp rate not set: Ramping sequentially"
+                )
+                return RampMode.SEQUENTIAL
+            violation = self._visa_station.find_vector_violation(
+                start_T=start_T, target_T=target_T
+            )
+        if violation is None:
+            return ramp_mode
+        logger.info(
+            f"{ramp_mode.name}: Intermediate field {violation} violates the field limit: Ramping sequentially"
+        )
+        return RampMode.SEQUENTIAL
+
+    def _start_vector_ramp(self) -> None:
+        "All magnets are armed: Start them at once."
+        self._vector_magnets = list(self._current_magnets)
+        visa_magnets = [m.visa_magnet for m in self._vector_magnets]
+        snapshots = self._visa_station.snapshots()
+        distance_T = {
+            m.visa_magnet.name: m.target_T - snapshots[m.visa_magnet.name].field_T
+            for m in self._vector_magnets
+        }
+        rate_max_Tpers = {
+            visa_magnet.name: min(
+                visa_magnet.field_ramp_TeslaPers,
+                visa_magnet.magnet.max_rampr_rate_Tpers,
+            )
+            for visa_magnet in visa_magnets
+        }
+        self._vector_duration_s, rates_Tpers = vector_ramp_rates(
+            distance_T=distance_T, rate_max_Tpers=rate_max_Tpers
+        )
+        self._vector_sequential_s = sum(
+            abs(distance_T[name]) / rate_max_Tpers[name] for name in distance_T
+        )
+        current_magnets = {m.visa_magnet.name: m for m in self._vector_magnets}
+        self._visa_station.for_each_magnet(
+            lambda visa_magnet: current_magnets[visa_magnet.name].configure_vector_ramp(
+                rates_Tpers[visa_magnet.name]
+            ),
+            visa_magnets=visa_magnets,
+        )
+        self._vector_start_s = time.time()
+        self._visa_station.for_each_magnet(
+            lambda visa_magnet: visa_magnet.write_raw("RAMP"),
+            visa_magnets=visa_magnets,
+        )
+        burst_s = time.time() - self._vector_start_s
+        for current_magnet in self._vector_magnets:
+            current_magnet.vector_ramp_started()
+        logger.info(
+            f"{LoggerTags.VECTOR_RAMP_S.name} start: expected {self._vector_duration_s:0.1f}s, sequential estimate {self._vector_sequential_s:0.1f}s, RAMP burst {1000.0*burst_s:0.1f}ms"
+        )
+
+    def _tick_vector(self) -> None:
+        if self._vector_start_s is None:
+            if len(self._current_magnets) == 0:
+                return
+            if all(current_magnet.armed for current_magnet in self._current_magnets):
+                self._start_vector_ramp()
+            return
+        holdings_s = [m.holding_s for m in self._vector_magnets]
+        if None in holdings_s:
+            return
+        logger.info(
+            f"{LoggerTags.VECTOR_RAMP_S.name} achieved {max(holdings_s)-self._vector_start_s:0.1f}s, expected {self._vector_duration_s:0.1f}s, sequential estimate {self._vector_sequential_s:0.1f}s, arrival spread {max(holdings_s)-min(holdings_s):0.2f}s"
+        )
+        self._vector_start_s = None
+        self._vector_magnets = []
+
+    def abort(self) -> None:
+        "Forget the current magnets and the pending magnets."
+        self._magnets_to_be_ramped.clear()
+        self._current_magnets.clear()
+        self._prewarm_magnets = {}
+        self._vector_magnets = []
+        self._vector_start_s = None
+        self._legs = []
+        self.done = True
+        self.abort_requested = False
+
+    def next_tick_interval_s(self) -> float:
+        if self.done:
+            return TICK_INTERVAL_IDLE_S
+        if len(self._current_magnets) == 0:
+            # The next magnet is about to start
+            return TICK_INTERVAL_MIN_S
+        return min(
+            current_magnet.next_tick_interval_s()
+            for current_magnet in itertools.chain(
+                self._current_magnets, self._prewarm_magnets.values()
+            )
+        )
+
+    def _predict_queued_s(self, visa_magnet: "VisaMagnet") -> float:
+        snapshot = visa_magnet.recent_snapshot(self._visa_station.status_max_age_s)
+        target_T = self._leg_target_T.get(
+            visa_magnet.name, visa_magnet.field_setpoint_Tesla
+        )
+        if visa_magnet.field_unchanged(target_T, snapshot):
+            # Most likely skipped
+            return 0.0
+        vector = self._ramp_mode is RampMode.VECTOR
+        phases = ramp_phases(
+            magnet=visa_magnet.magnet,
+            # Prewarming: Expected to be warm when it is its turn
+            switchheater_warm=bool(snapshot.switchheater_state)
+            or visa_magnet.name in self._prewarm_magnets,
+            vector=vector,
+            holding_switchheater_on=self._visa_station.holding_switchheater_on
+            or not self._final_leg
+            or self.lazy_cooling,
+            holding_current=self._visa_station.holding_current
+            or not self._final_leg
+            or self.lazy_cooling,
+        )
+        return sum(
+            predict_phase_s(
+                visa_magnet=visa_magnet,
+                phase=phase,
+                start_T=snapshot.field_T,
+                target_T=target_T,
+                rate_Tpers=visa_magnet.field_ramp_TeslaPers,
+                segments_Tpers=None if vector else visa_magnet.ramp_segments_Tpers,
+            )
+            for phase in phases
+        )
+
+    def remaining_s(self) -> float:
+        """
+        The predicted time till the station ramp is done.
+        The legs of RampMode.PLANNED still to come are taken from the plan.
+        """
+        if self.done:
+            return 0.0
+        magnets_s = [
+            current_magnet.remaining_s() for current_magnet in self._current_magnets
+        ]
+        magnets_s.extend(
+            self._predict_queued_s(visa_magnet)
+            for visa_magnet in self._magnets_to_be_ramped
+        )
+        if self._ramp_mode is RampMode.SEQUENTIAL:
+            remaining_s = sum(magnets_s)
+        else:
+            remaining_s = max(magnets_s, default=0.0)
+        return remaining_s + sum(leg.duration_s for leg in self._legs)
 
     @property
     def statetext(self) -> str:
-        states = [visa_magnet.name for visa_magnet in self._magnets_to_be_ramped]
-        if self._current_magnet is not None:
-            states.insert(0, self._current_magnet.statetext)
+        states = [current_magnet.statetext for current_magnet in self._current_magnets]
+        for visa_magnet in self._magnets_to_be_ramped:
+            prewarm_magnet = self._prewarm_magnets.get(visa_magnet.name, None)
+            if prewarm_magnet is None:
+                states.append(visa_magnet.name)
+                continue
+            states.append(prewarm_magnet.statetext)
         return ",".join(states)
 
     def tick(self):
         "process next step"
-        if self._current_magnet is None:
+        if self.abort_requested:
+            return
+        if len(self._current_magnets) == 0:
             if len(self._magnets_to_be_ramped) == 0:
+                if len(self._legs) > 0:
+                    self._start_leg()
+                    return
                 # We are done: All magnets reached the new field and
                 # are in state HOLDING
                 self.done = True
                 return
 
-            # Lets ramp the field of the next magnet
-            self._current_magnet = RampingStatemachineMagnet(
-                visa_magnet=self._magnets_to_be_ramped.pop(0)
-            )
-
-        self._current_magnet.tick()
-
-        if self._current_magnet.is_done():
-            self._current_magnet = None
+            # Lets ramp the field of the next magnet: Or of all magnets
+            count = len(self._magnets_to_be_ramped)
+            if self._ramp_mode is RampMode.SEQUENTIAL:
+                count = 1
+            for _ in range(count):
+                visa_magnet = self._magnets_to_be_ramped.pop(0)
+                current_magnet = self._prewarm_magnets.pop(visa_magnet.name, None)
+                if current_magnet is None:
+                    current_magnet = self._new_current_magnet(visa_magnet)
+                else:
+                    current_magnet.release()
+                self._current_magnets.append(current_magnet)
+
+        for current_magnet in self._current_magnets:
+            current_magnet.tick()
+        for prewarm_magnet in self._prewarm_magnets.values():
+            prewarm_magnet.tick()
+
+        self._current_magnets = [
+            current_magnet
+            for current_magnet in self._current_magnets
+            if not current_magnet.is_done()
+        ]
+        if self._ramp_mode is RampMode.VECTOR:
+            self._tick_vector()
 
 
 class VisaStation:
@@ -413,10 +1202,57 @@ class VisaStation:
             visa_station=self
         )
         self._mode: ControlMode = ControlMode.PASSIVE
+        self.ramp_mode: RampMode = RampMode.SEQUENTIAL
+        self._executor = ThreadPoolExecutor(
+            max_workers=Axis.AXIS3.value, thread_name_prefix="AMI430_visa"
+        )
+        "Every magnet is a separate socket: Station wide visa i/o is done concurrently."
+        self.metrics = VisaMetrics()
+        "Latency per axis and command verb"
+        self.recorder: Optional[ScpiRecorder] = None
+        self.replay_session: Optional[ScpiReplaySession] = None
+        self.published_snapshot: Optional[StationSnapshot] = None
+        "Written by the visa thread, read by the labber thread without lock"
+        self.published_ramp_eta: Tuple[float, float] = (0.0, 100.0)
+        "'ramp_eta()' of the last tick: The labber thread must not read the state machine"
+        self.status_max_age_s = STATUS_MAX_AGE_S
+        "An older 'published_snapshot' is not used: The value is queried from the magnet."
+        self._ramp_done: Optional[Future] = None
+        "Resolved by 'tick()' when the ramp started by 'start_ramp_wait()' is over"
+        self._ramp_start_s = time.time()
+        self._abort_requested_s: Optional[float] = None
+        self.abort_latency_s = 0.0
+        "From the abort request till all supplies confirmed PAUSE"
+        self.planned_ramp_s = 0.0
+        "Duration of the last path planned by RampMode.PLANNED"
+        self.ramp_history = RampHistory(
+            filename=(
+                DIRECTORY_TMP / f"tmp_AMI430_{station.name}_ramps.jsonl"
+                if station.ramp_history_filename is None
+                else station.ramp_history_filename
+            )
+        )
+        "Completed ramps: Used to predict the duration of the next ramp"
+        self.setpoint_list: List[SetpointListPoint] = []
+        "Loaded by 'Control / Setpoint List'"
+        self._setpoint_list_pending = False
+        "The next ramp runs 'setpoint_list' instead of a single setpoint"
+        self._setpoint_list_index: Optional[int] = None
+        "The point ramped to or dwelled at. None: No list running"
+        self._dwell_until_s: Optional[float] = None
+        self.setpoint_list_arrivals_s: List[float] = []
+        "When the points of the running list were reached"
+        self.switchheater_cool_delay_s = 0.0
+        "Lazy cooling policy: Keep the switch heater of Z warm this long after a ramp"
+        self._cooling_pending = False
+        "The running ramp keeps the switch heater warm: Cool it after the delay"
+        self._cool_due_s: Optional[float] = None
+        self.switchheater_saved_s = 0.0
+        "Switch heater time saved by the lazy cooling policy"
         self.init_logger()
 
     def init_logger(self) -> None:
-        logfile = DIRECTORY_OF_THIS_FILE / f"tmp_AMI430_{self.station.name}.log"
+        logfile = DIRECTORY_TMP / f"tmp_AMI430_{self.station.name}.log"
         fh = logging.FileHandler(logfile)
         fh.setLevel(logging.DEBUG)
         formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
@@ -439,25 +1275,43 @@ class VisaStation:
     def statetext(self) -> str:
         return self._state_machine.statetext
 
-    def get_labber_state(self) -> LabberState:
-        if not self._state_machine.done:
+    @property
+    def lazy_cooling(self) -> bool:
+        """
+        Keep the switch heater of Z warm after a ramp: It is cooled only if
+        no ramp starts within 'switchheater_cool_delay_s'.
+        """
+        if self.holding_switchheater_on or self.switchheater_cool_delay_s <= 0.0:
+            return False
+        if self.visa_magnet_z is None:
+            return False
+        return self.visa_magnet_z.magnet.has_switchheater
+
+    def get_labber_state(
+        self, snapshots: Optional[Dict[str, MagnetSnapshot]] = None
+    ) -> LabberState:
+        if not self._state_machine.done or self._setpoint_list_index is not None:
             return LabberState.MISALIGNED
 
-        def fix_state(visa_magnet: VisaMagnet) -> AMI430State:
-            logger.info("We are checking if we can terminate the statemachine")
-            logger.info(
+        def fix_state(visa_magnet: VisaMagnet, snapshot: MagnetSnapshot) -> AMI430State:
+            logger.debug("We are checking if we can terminate the statemachine")
+            logger.debug(
                 f"****************************The relevant variables are Switchheater yes/no {visa_magnet.magnet.has_switchheater}Hold current yes/no {visa_magnet.visa_station.holding_current} Hold switchheater yes/no {visa_magnet.visa_station.holding_switchheater_on}"
             )
             if visa_magnet.magnet.has_switchheater:
                 if not visa_magnet.visa_station.holding_current:
-                    if visa_magnet.visa_state is AMI430State.AT_ZERO_CURRENT:
+                    if snapshot.state is AMI430State.AT_ZERO_CURRENT:
                         return AMI430State.HOLDING
                 if not visa_magnet.visa_station.holding_switchheater_on:
-                    if visa_magnet.visa_state is AMI430State.PAUSED:
+                    if snapshot.state is AMI430State.PAUSED:
                         return AMI430State.HOLDING
-            return visa_magnet.visa_state
+            return snapshot.state
 
-        states = {fix_state(magnet) for magnet in self.visa_magnets}
+        if snapshots is None:
+            snapshots = self.snapshots()
+        states = {
+            fix_state(magnet, snapshots[magnet.name]) for magnet in self.visa_magnets
+        }
         if len(states) > 1:
             logger.info(f"LabberState.MISALIGNED: {states}")
             return LabberState.MISALIGNED
@@ -466,10 +1320,544 @@ class VisaStation:
         assert isinstance(state, AMI430State)
         return state.labber_state
 
+    def is_field_allowed(self, field_T: Dict[str, float]) -> bool:
+        """
+        'field_T': magnet name -> field.
+        Applies 'Station.validate_field_limit' to a field which is not the setpoint.
+        """
+        proxy = SimpleNamespace(
+            station=self.station,
+            visa_magnet_x=None,
+            visa_magnet_y=None,
+            visa_magnet_z=None,
+        )
+        for visa_magnet in self.visa_magnets:
+            setattr(
+                proxy,
+                f"visa_magnet_{visa_magnet.name.lower()}",
+                SimpleNamespace(field_setpoint_Tesla=field_T[visa_magnet.name]),
+            )
+        try:
+            self.station.validate_field_limit(visa_station=proxy)
+        except FieldLimitViolation:
+            return False
+        return True
+
+    def find_field_limit_violation(
+        self, start_T: Dict[str, float], target_T: Dict[str, float]
+    ) -> Optional[Dict[str, float]]:
+        """
+        The magnets may reach their target in any order and at any time:
+        Every combination of intermediate fields has to be within the field limit.
+        The limits tighten monotonically with the field magnitude per axis:
+        The corners of the box and the zero crossings of its edges suffice.
+        Returns the first combination violating the limit, None if all are allowed.
+        """
+        names = sorted(target_T)
+        samples_T = []
+        for name in names:
+            ends_T = (start_T[name], target_T[name])
+            crosses_zero = min(ends_T) < 0.0 < max(ends_T)
+            samples_T.append(ends_T + (0.0,) if crosses_zero else ends_T)
+        for combination_T in itertools.product(*samples_T):
+            field_T = dict(zip(names, combination_T))
+            if not self.is_field_allowed(field_T):
+                return field_T
+        return None
+
+    def find_vector_violation(
+        self, start_T: Dict[str, float], target_T: Dict[str, float]
+    ) -> Optional[Dict[str, float]]:
+        """
+        The magnets move on a straight line from 'start_T' to 'target_T'.
+        Returns the first field violating the limit, None if all are allowed.
+        """
+        return AMI430_planner.find_line_violation(
+            start_T=start_T, target_T=target_T, is_field_allowed=self.is_field_allowed
+        )
+
+    def plan_ramp(self, start_T: Dict[str, float]) -> AMI430_planner.Plan:
+        """
+        The fastest path from 'start_T' to the setpoints within the field limit.
+        Raises FieldLimitViolation if there is none.
+        """
+        plan = AMI430_planner.plan_path(
+            start_T=start_T,
+            target_T={
+                visa_magnet.name: visa_magnet.field_setpoint_Tesla
+                for visa_magnet in self.visa_magnets
+            },
+            rate_Tpers={
+                visa_magnet.name: min(
+                    visa_magnet.field_ramp_TeslaPers,
+                    visa_magnet.magnet.max_rampr_rate_Tpers,
+                )
+                for visa_magnet in self.visa_magnets
+            },
+            is_field_allowed=self.is_field_allowed,
+        )
+        self.planned_ramp_s = plan.duration_s
+        logger.info(f"{LoggerTags.RAMP_PLAN.name} {plan.text}")
+        return plan
+
+    def for_each_magnet(
+        self,
+        func: Callable[["VisaMagnet"], Any],
+        visa_magnets: Optional[List["VisaMagnet"]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Call 'func(visa_magnet)' for all magnets concurrently, one worker per socket.
+        The call takes as long as the slowest supply.
+        Returns a dict 'visa_magnet.name' -> result.
+        Raises VisaMagnetException naming the magnet which failed.
+        """
+        if visa_magnets is None:
+            visa_magnets = self.visa_magnets
+        owner = scope_owner()
+
+        def call(visa_magnet: "VisaMagnet") -> Any:
+            _scope_owner.ident = owner
+            try:
+                return func(visa_magnet)
+            finally:
+                del _scope_owner.ident
+
+        futures = {
+            visa_magnet.name: self._executor.submit(call, visa_magnet)
+            for visa_magnet in visa_magnets
+        }
+        results = {}
+        exceptions = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as ex:  # pylint: disable=broad-except
+                exceptions[name] = ex
+        if len(exceptions) > 0:
+            for name, ex in exceptions.items():
+                logger.error(f"Magnet {name}: {ex!r}")
+            name, ex = next(iter(exceptions.items()))
+            if isinstance(ex, VisaMagnetException):
+                raise ex
+            raise VisaMagnetException(magnet_name=name, msg=repr(ex)) from ex
+        return results
+
+    def snapshots(self) -> Dict[str, MagnetSnapshot]:
+        return self.for_each_magnet(lambda visa_magnet: visa_magnet.snapshot())
+
+    def recent_snapshots(self) -> Dict[str, MagnetSnapshot]:
+        """
+        Like 'snapshots()', but a snapshot younger than 'status_max_age_s' is reused:
+        Between ramps, the visa thread keeps them recent.
+        """
+        return self.for_each_magnet(
+            lambda visa_magnet: visa_magnet.recent_snapshot(self.status_max_age_s)
+        )
+
+    def pause_all(self, deadline_s: float = ABORT_DEADLINE_S) -> bool:
+        """
+        PAUSE every supply concurrently.
+        Returns False if not all supplies confirmed within 'deadline_s':
+        These will receive the PAUSE as soon as their socket is free.
+        Also False if a PAUSE failed.
+        May be called without the lock: Every VisaMagnet serializes the access to its socket.
+        """
+        futures = {
+            self._executor.submit(visa_magnet.write_raw, "PAUSE"): visa_magnet.name
+            for visa_magnet in self.visa_magnets
+        }
+        done, not_done = concurrent.futures.wait(futures, timeout=deadline_s)
+        confirmed = len(not_done) == 0
+        for future in done:
+            if future.exception() is not None:
+                logger.error(f"PAUSE {futures[future]}: {future.exception()!r}")
+                confirmed = False
+        for future in not_done:
+            logger.error(f"PAUSE {futures[future]}: No response within {deadline_s}s")
+        return confirmed
+
+    def _pause_failed(self) -> None:
+        "Not recorded as abort latency: The supplies did not confirm the PAUSE."
+        duration_s = time.time() - self._abort_requested_s
+        self.metrics.record(axis="STATION", verb="ABORT_FAILED", duration_s=duration_s)
+        logger.error(
+            f"{LoggerTags.ABORT_LATENCY_S.name} failed: Not all supplies confirmed PAUSE after {duration_s:0.3f}s"
+        )
+
+    def request_abort(self) -> None:
+        """
+        Low latency part of the abort: May be called without the lock.
+        Stops the state machine and pauses all supplies.
+        'abort()' has to follow with the lock aquired.
+        """
+        if self._abort_requested_s is None:
+            self._abort_requested_s = time.time()
+        self._state_machine.abort_requested = True
+        if not self.pause_all():
+            self._pause_failed()
+            return
+        self.abort_latency_s = time.time() - self._abort_requested_s
+        self.metrics.record(
+            axis="STATION", verb="ABORT", duration_s=self.abort_latency_s
+        )
+        logger.info(f"{LoggerTags.ABORT_LATENCY_S.name} {self.abort_latency_s:0.3f}")
+
+    def abort(self) -> None:
+        """
+        Stop ramping: All supplies PAUSED, no magnet pending and the state machine done.
+        Requires the lock: No tick runs concurrently.
+        """
+        if self._abort_requested_s is None:
+            self.request_abort()
+        else:
+            # A tick running during 'request_abort()' might have sent RAMP after the PAUSE
+            if not self.pause_all():
+                self._pause_failed()
+        self._abort_requested_s = None
+        logger.info(f"Abort: {self.statetext}")
+        switchheater_warm = (
+            self._cooling_pending
+            or self._cool_due_s is not None
+            or (self.lazy_cooling and not self._state_machine.done)
+        )
+        self._state_machine.abort()
+        self._setpoint_list_index = None
+        self._dwell_until_s = None
+        if switchheater_warm:
+            # The switch heater may still be warm: Cool it after the delay
+            self._cooling_pending = True
+            self._cool_due_s = None
+        self.published_snapshot = None
+        if self._ramp_done is not None:
+            self._ramp_done.set_result(LabberState.PAUSED)
+            self._ramp_done = None
+
+    def validate_setpoint_list(self, points: List[SetpointListPoint]) -> None:
+        for i, point in enumerate(points):
+            if not self.is_field_allowed(point.field_T):
+                raise FieldLimitViolation(
+                    f"Setpoint list point {i} {point.field_T} violates the field limit"
+                )
+
+    def _apply_setpoint(self, point: SetpointListPoint) -> None:
+        for visa_magnet in self.visa_magnets:
+            visa_magnet.field_setpoint_Tesla = point.field_T[visa_magnet.name]
+
     def start_ramping(self) -> None:
-        self._state_machine.start_ramping()
+        # The published status does not reflect the ramp yet
+        self.published_snapshot = None
+        if self._setpoint_list_pending:
+            self._setpoint_list_pending = False
+            self._setpoint_list_index = 0
+            self._dwell_until_s = None
+            self.setpoint_list_arrivals_s = []
+            self._apply_setpoint(self.setpoint_list[0])
+            logger.info(
+                f"{LoggerTags.SETPOINT_LIST.name} start: {len(self.setpoint_list)} points"
+            )
+        switchheater_warm = self._cooling_pending or self._cool_due_s is not None
+        self._start_state_machine()
+        if switchheater_warm:
+            # Started: The switch heater is still warm
+            self._cool_due_s = None
+            self._count_saved_cycle()
+        self._cooling_pending = self._state_machine.lazy_cooling
+        self._ramp_start_s = time.time()
+
+    def _start_state_machine(self) -> None:
+        try:
+            self._state_machine.start_ramping()
+        except FieldLimitViolation:
+            # Nothing was queued: A running setpoint list stops here
+            self._setpoint_list_index = None
+            self._dwell_until_s = None
+            raise
+
+    def start_ramp_wait(self) -> Future:
+        """
+        Start ramping. The returned future is resolved by 'tick()':
+        Result 'LabberState.HOLDING' or the exception which failed the ramp.
+        A lost connection does not fail the ramp: The ramp continues after the reconnect.
+        """
+        if not self._setpoint_list_pending:
+            # The points of a list are validated when loaded
+            self.station.validate_field_limit(visa_station=self)
+        if self._ramp_done is not None:
+            self._ramp_done.cancel()
+        self.start_ramping()
+        self._ramp_done = Future()
+        return self._ramp_done
+
+    def _update_ramp_wait(self) -> None:
+        if self._ramp_done is None:
+            return
+        labber_state = self.published_snapshot.labber_state
+        logger.info(f"{LoggerTags.LABBER_STATE.name} {labber_state.name}")
+        logger.info(
+            f"{LoggerTags.RAMPING_DURATION_S.name} {time.time()-self._ramp_start_s:0.3} {self.statetext}"
+        )
+        if labber_state == LabberState.HOLDING:
+            logger.info(
+                f"RAMPING WAIT: {time.time()-self._ramp_start_s:0.3}s queries avoided: {self.queries_avoided}"
+            )
+            self._ramp_done.set_result(labber_state)
+            self._ramp_done = None
+            return
+        if not labber_state in (LabberState.RAMPING, LabberState.MISALIGNED):
+            logger.warning(f"Unexected labber state '{labber_state.name}'")
+
+    def _preload_setpoint(self, point: SetpointListPoint) -> None:
+        """
+        While dwelling: PAUSE the magnets moving next and configure their target.
+        The next ramp finds the shadow registers matching and just sends RAMP.
+        Not with a cold switch: The supply current has to match the magnet first.
+        """
+        if self.ramp_mode is RampMode.PLANNED:
+            # The targets may be waypoints
+            return
+        snapshots = self.snapshots()
+
+        def preload(visa_magnet: VisaMagnet) -> None:
+            snapshot = snapshots[visa_magnet.name]
+            target_T = point.field_T[visa_magnet.name]
+            if visa_magnet.field_unchanged(target_T, snapshot):
+                return
+            if visa_magnet.magnet.has_switchheater and not snapshot.switchheater_state:
+                return
+            if visa_magnet.conf_matches("CONF:FIELD:TARG", target_T):
+                return
+            visa_magnet.write_raw("PAUSE")
+            visa_magnet.write_conf("CONF:FIELD:TARG", target_T)
+
+        self.for_each_magnet(preload)
+
+    def _tick_setpoint_list(self) -> None:
+        """
+        Arrived at a point: Dwell, then ramp to the next point.
+        Loops as long as ramps complete immediately.
+        """
+        while self._setpoint_list_index is not None and self._state_machine.done:
+            point = self.setpoint_list[self._setpoint_list_index]
+            if self._dwell_until_s is None:
+                arrival_s = time.time()
+                self.setpoint_list_arrivals_s.append(arrival_s)
+                self._dwell_until_s = arrival_s + point.dwell_s
+                logger.info(
+                    f"{LoggerTags.SETPOINT_LIST.name} point {self._setpoint_list_index} {point.field_T} reached after {arrival_s-self._ramp_start_s:0.1f}s"
+                )
+                if self._setpoint_list_index + 1 < len(self.setpoint_list):
+                    self._preload_setpoint(
+                        self.setpoint_list[self._setpoint_list_index + 1]
+                    )
+            if time.time() < self._dwell_until_s:
+                return
+            self._dwell_until_s = None
+            self._setpoint_list_index += 1
+            if self._setpoint_list_index == len(self.setpoint_list):
+                self._setpoint_list_index = None
+                logger.info(f"{LoggerTags.SETPOINT_LIST.name} done")
+                return
+            self._apply_setpoint(self.setpoint_list[self._setpoint_list_index])
+            switchheater_warm = self._state_machine.lazy_cooling
+            self._start_state_machine()
+            if switchheater_warm:
+                self._count_saved_cycle()
+            self._ramp_start_s = time.time()
+            self._tick()
+
+    def _count_saved_cycle(self) -> None:
+        """
+        Z ramps with the switch heater kept warm by the lazy cooling policy:
+        Cooling, zeroing, matching the current and heating are saved.
+        """
+        visa_magnet = self.visa_magnet_z
+        snapshot = visa_magnet.recent_snapshot(self.status_max_age_s)
+        if visa_magnet.field_unchanged(visa_magnet.field_setpoint_Tesla, snapshot):
+            # Z does not move: The switch would not have been heated
+            return
+        phases = [
+            MagnetRampingState.WAITFOR_SWITCH_COLD,
+            MagnetRampingState.WAITFOR_CURRENT,
+            MagnetRampingState.WAITFOR_SWITCH_WARM,
+        ]
+        if not self.holding_current:
+            phases.append(MagnetRampingState.WAITFOR_ZERO_CURRENT)
+        saved_s = sum(
+            predict_phase_s(
+                visa_magnet=visa_magnet,
+                phase=phase,
+                start_T=0.0,
+                target_T=0.0,
+                rate_Tpers=0.0,
+            )
+            for phase in phases
+        )
+        self.switchheater_saved_s += saved_s
+        logger.info(
+            visa_magnet.prefix(
+                f"Lazy cooling: Switch heater still warm, saved {saved_s:0.1f}s"
+            )
+        )
+
+    def _tick_lazy_cooling(self) -> None:
+        """
+        Cool the switch heater kept warm by the lazy cooling policy
+        once no ramp started within 'switchheater_cool_delay_s'.
+        """
+        if not self._state_machine.done or self._setpoint_list_index is not None:
+            return
+        if self._cooling_pending:
+            self._cooling_pending = False
+            self._cool_due_s = time.time() + self.switchheater_cool_delay_s
+        if self._cool_due_s is None or time.time() < self._cool_due_s:
+            return
+        self._cool_due_s = None
+        visa_magnet = self.visa_magnet_z
+        snapshot = visa_magnet.recent_snapshot(self.status_max_age_s)
+        if not snapshot.switchheater_state:
+            logger.info(visa_magnet.prefix("Lazy cooling: Switch heater already cold"))
+            return
+        logger.info(
+            visa_magnet.prefix(
+                f"Lazy cooling: No ramp within {self.switchheater_cool_delay_s:0.1f}s, cooling the switch heater"
+            )
+        )
+        target_T = visa_magnet.field_setpoint_Tesla
+        if not visa_magnet.field_unchanged(target_T, snapshot):
+            # The ramp was aborted: Persist where the magnet is
+            target_T = snapshot.field_T
+        self._state_machine.start_persisting(visa_magnet, target_T=target_T)
+        self._tick()
+
+    def _cool_before_close(self) -> None:
+        "The lazy cooling policy kept the switch heater warm: Do not leave it warm."
+        if not self._cooling_pending and self._cool_due_s is None:
+            return
+        self._cooling_pending = False
+        self._cool_due_s = None
+        visa_magnet = self.visa_magnet_z
+        try:
+            snapshot = visa_magnet.snapshot()
+            if snapshot.switchheater_state and snapshot.state == AMI430State.HOLDING:
+                logger.warning(
+                    visa_magnet.prefix(
+                        "Lazy cooling: Closing, cooling the switch heater without waiting"
+                    )
+                )
+                visa_magnet.write_raw("PS 0")
+                return
+        except Exception as ex:
+            logger.exception(ex)
+        logger.warning(
+            visa_magnet.prefix(
+                "Lazy cooling: Closing, the switch heater was not cooled and may still be warm"
+            )
+        )
+
+    def fail_ramp_wait(self, ex: Exception) -> None:
+        if self._ramp_done is None:
+            return
+        self._ramp_done.set_exception(ex)
+        self._ramp_done = None
+
+    @contextlib.contextmanager
+    def tick_scope(self):
+        """
+        Within this scope, every instrument value is fetched at most once.
+        """
+        visa_magnets = self.visa_magnets
+        for visa_magnet in visa_magnets:
+            visa_magnet.begin_tick()
+        try:
+            yield
+        finally:
+            for visa_magnet in visa_magnets:
+                visa_magnet.end_tick()
+
+    @property
+    def queries_avoided(self) -> int:
+        return sum(visa_magnet.queries_avoided for visa_magnet in self.visa_magnets)
+
+    def next_tick_interval_s(self) -> float:
+        """
+        When the visa thread should tick next, depending on the ramping state.
+        """
+        if not all(visa_magnet.connected for visa_magnet in self.visa_magnets):
+            return RECONNECT_BACKOFF_MIN_S
+        interval_s = self._state_machine.next_tick_interval_s()
+        for due_s in (self._dwell_until_s, self._cool_due_s):
+            if due_s is not None:
+                interval_s = min(interval_s, max(due_s - time.time(), 0.0))
+        return interval_s
 
     def tick(self) -> None:
+        self.for_each_magnet(lambda visa_magnet: visa_magnet.maintain_connection())
+        if not all(visa_magnet.connected for visa_magnet in self.visa_magnets):
+            # The ramping state is preserved till all magnets are connected again
+            logger.debug(f"Waiting for reconnect: {self.statetext}")
+            return
+        try:
+            with self.tick_scope():
+                # All magnets concurrently: The state machines use the cached responses
+                self.snapshots()
+                self._tick()
+                self._tick_setpoint_list()
+                self._tick_lazy_cooling()
+                self.publish_snapshot()
+                self._update_ramp_wait()
+        except (RampTimeoutException, FieldLimitViolation) as ex:
+            # The ramp failed: Labber stops waiting
+            self.fail_ramp_wait(ex)
+            raise
+        # Any other exception, for example a lost connection:
+        # The ramping state survives and Labber keeps waiting for the ramp.
+
+    def ramp_eta(self) -> Tuple[float, float]:
+        """
+        Returns (remaining_s, progress_percent) of the active ramp.
+        Reads the state machine: Only the visa thread, see 'published_ramp_eta'.
+        """
+        if self._state_machine.done:
+            return 0.0, 100.0
+        remaining_s = self._state_machine.remaining_s()
+        elapsed_s = time.time() - self._ramp_start_s
+        if elapsed_s + remaining_s <= 0.0:
+            return 0.0, 100.0
+        return remaining_s, 100.0 * elapsed_s / (elapsed_s + remaining_s)
+
+    def publish_snapshot(self) -> None:
+        """
+        Replaces 'published_snapshot': A single reference assignment, atomic for the readers.
+        """
+        self.published_ramp_eta = self.ramp_eta()
+        self.published_snapshot = self.take_snapshot()
+
+    def take_snapshot(self) -> StationSnapshot:
+        """
+        The status of all magnets: One pipelined exchange per magnet, concurrently.
+        """
+        snapshots = self.snapshots()
+        switchheater_state = 0
+        if self.visa_magnet_z is not None:
+            if self.visa_magnet_z.magnet.has_switchheater:
+                switchheater_state = snapshots[
+                    self.visa_magnet_z.name
+                ].switchheater_state
+        ramp_eta_s, ramp_progress_percent = self.published_ramp_eta
+        return StationSnapshot(
+            time_s=min(snapshot.time_s for snapshot in snapshots.values()),
+            magnets=snapshots,
+            labber_state=self.get_labber_state(snapshots=snapshots),
+            switchheater_state=switchheater_state,
+            ramp_eta_s=ramp_eta_s,
+            ramp_progress_percent=ramp_progress_percent,
+            setpoint_list_index=(
+                -1 if self._setpoint_list_index is None else self._setpoint_list_index
+            ),
+            setpoint_list_arrivals_s=tuple(self.setpoint_list_arrivals_s),
+        )
+
+    def _tick(self) -> None:
         textstate_before = self.statetext
 
         while True:
@@ -488,21 +1876,37 @@ class VisaStation:
             assert magnet is not None
             assert isinstance(magnet, Magnet)
             assert isinstance(name, str)
-            visa_magnet = VisaMagnet(visa_station=self, magnet=magnet, name=name)
-            if initialize_visa:
-                visa_magnet.open()
-            return visa_magnet
+            return VisaMagnet(visa_station=self, magnet=magnet, name=name)
 
+        start_s = time.time()
+        if initialize_visa:
+            if self.station.visa_recording_filename is not None:
+                self.recorder = ScpiRecorder(self.station.visa_recording_filename)
+            if isinstance(self.station.use_visa_simulation, VisaReplay):
+                self.replay_session = ScpiReplaySession(
+                    filename=self.station.use_visa_simulation.filename,
+                    time_compression=self.station.use_visa_simulation.time_compression,
+                )
         if self.station.axis == Axis.AXIS3:
             self.visa_magnet_x = add_magnet(self.station.x_axis, name="X")
         self.visa_magnet_y = add_magnet(self.station.y_axis, name="Y")
         self.visa_magnet_z = add_magnet(self.station.z_axis, name="Z")
+        if initialize_visa:
+            self.for_each_magnet(lambda visa_magnet: visa_magnet.open())
+        logger.info(f"VisaStation.open() took {time.time()-start_s:0.3f}s")
 
     def close(self) -> None:
-        for visa_magnet in self.visa_magnets:
-            visa_magnet.close()
+        self._cool_before_close()
+        self.for_each_magnet(lambda visa_magnet: visa_magnet.close())
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        # Labber opens a new station: Do not leak the workers
+        self._executor.shutdown(wait=False)
 
     def set_quantity(self, quantity: Quantity, value):
+        # The published status does not reflect the new configuration yet
+        self.published_snapshot = None
         value_new = self._set_quantity(quantity, value)
         logger.info(f"{LoggerTags.LABBER_SET.name} {quantity.name} {value} {value_new}")
         return value_new
@@ -527,12 +1931,30 @@ class VisaStation:
             )
             return max_ramp_Tpers
 
+        if quantity is Quantity.ControlSetpointList:
+            points = parse_setpoint_list(
+                value,
+                magnet_names=[visa_magnet.name for visa_magnet in self.visa_magnets],
+            )
+            self.validate_setpoint_list(points)
+            self.setpoint_list = points
+            self._setpoint_list_pending = len(points) > 0
+            return value
         if quantity is Quantity.ControlLogging:
             self._logging = EnumLogging.get_exception(value)
             return value
         if quantity is Quantity.ControlMode:
             self._mode = ControlMode.get_valuelabber_exception(value)
             return value
+        if quantity is Quantity.ControlRampMode:
+            self.ramp_mode = RampMode.get_valuelabber_exception(value)
+            return value
+        if quantity is Quantity.ControlStatusMaxAge:
+            self.status_max_age_s = max(float(value), 0.0)
+            return self.status_max_age_s
+        if quantity is Quantity.ControlSwitchheaterCoolDelay:
+            self.switchheater_cool_delay_s = max(float(value), 0.0)
+            return self.switchheater_cool_delay_s
         if quantity is Quantity.StatusSwitchheaterStatus:
             # TODO
             v_dict = {"ON": True, "OFF": False}
@@ -568,6 +1990,9 @@ class VisaStation:
                 if value == LabberState.RAMPING.name:
                     self.start_ramping()
                     return
+                if value == LabberState.PAUSED.name:
+                    self.abort()
+                    return
 
                 logger.warning(
                     f"set_quantity: quantity={quantity.name}: can not set state {value}"
@@ -578,29 +2003,15 @@ class VisaStation:
 
         raise Exception(f"set_quantity(): Unknown quantity '{quantity.name}' {value}")
 
-    def wait_till_ramped(self):
-        self.station.validate_field_limit(visa_station=self)
-        self.start_ramping()
-        start_s = time.time()
-        while True:
-            labber_state = (
-                self.get_labber_state()
-            )  # we change the order here to observe if this changes something.
+    def wait_till_ramped(self) -> LabberState:
+        """
+        Ramp and tick till done: For use without 'VisaThread'.
+        """
+        ramp_done = self.start_ramp_wait()
+        while not ramp_done.done():
             self.tick()
-            logger.info(f"Status of the RampingStatemachine {self._state_machine.done}")
-            logger.info(f"{LoggerTags.LABBER_STATE.name} {labber_state.name}")
-            logger.info(
-                f"{LoggerTags.RAMPING_DURATION_S.name} {time.time()-start_s:0.3} {self.statetext}"
-            )
-            if labber_state == LabberState.HOLDING:
-                break
-            if not labber_state in (LabberState.RAMPING, LabberState.MISALIGNED):
-                logger.warning(f"Unexected labber state '{labber_state.name}'")
-            for magnet in self.visa_magnets:
-                magnet.visa_field_T
-
-            logger.info(f"RAMPING WAIT: {time.time()-start_s:0.3}s {self.statetext}")
-            time.sleep(1.0)
+            time.sleep(self.next_tick_interval_s())
+        return ramp_done.result()
 
     @property
     def switchheater_state(self) -> int:
@@ -609,7 +2020,7 @@ class VisaStation:
             return 0
         if not visa_magnet.magnet.has_switchheater:
             return 0
-        return visa_magnet.switchheater_state
+        return visa_magnet.snapshot().switchheater_state
 
     def get_quantity(self, quantity: Quantity) -> Any:
         assert isinstance(quantity, Quantity)
@@ -629,6 +2040,18 @@ class VisaStation:
             return self.get_labber_state().name
         if quantity is Quantity.ControlMode:
             return self._mode.name
+        if quantity is Quantity.ControlRampMode:
+            return self.ramp_mode.name
+        if quantity is Quantity.ControlStatusMaxAge:
+            return self.status_max_age_s
+        if quantity is Quantity.ControlSwitchheaterCoolDelay:
+            return self.switchheater_cool_delay_s
+        if quantity is Quantity.StatusSwitchheaterTimeSaved:
+            return self.switchheater_saved_s
+        if quantity is Quantity.StatusSnapshotAge:
+            if self.published_snapshot is None:
+                return 0.0
+            return self.published_snapshot.age_s
 
         visa_maget = self.quantity_setpoint_field.get(quantity, None)
         if visa_maget is not None:
@@ -640,11 +2063,48 @@ class VisaStation:
 
         visa_maget = self.quantity_magnet_state.get(quantity, None)
         if visa_maget is not None:
-            return visa_maget.visa_state.name
+            return visa_maget.snapshot().state.name
 
         visa_maget = self.quantity_magnet_field_actual.get(quantity, None)
         if visa_maget is not None:
-            return visa_maget.visa_field_T
+            return visa_maget.snapshot().field_T
+
+        visa_maget_percent = self.quantity_visa_latency_ms.get(quantity, None)
+        if visa_maget_percent is not None:
+            visa_maget, percent = visa_maget_percent
+            if visa_maget is None:
+                return 0.0
+            histogram = self.metrics.histogram(axis=visa_maget.name)
+            return 1000.0 * histogram.percentile_s(percent)
+
+        if quantity is Quantity.StatusVisaCalls:
+            return self.metrics.histogram().count
+        if quantity is Quantity.StatusAbortLatency:
+            return 1000.0 * self.abort_latency_s
+        if quantity is Quantity.StatusPlannedRampTime:
+            return self.planned_ramp_s
+        if quantity is Quantity.ControlSetpointList:
+            return [
+                value
+                for point in self.setpoint_list
+                for value in (
+                    point.field_T.get("X", 0.0),
+                    point.field_T["Y"],
+                    point.field_T["Z"],
+                    point.dwell_s,
+                )
+            ]
+        if quantity is Quantity.StatusSetpointListIndex:
+            if self._setpoint_list_index is None:
+                return -1
+            return self._setpoint_list_index
+        if quantity is Quantity.StatusSetpointListArrivals:
+            return list(self.setpoint_list_arrivals_s)
+        if quantity in (Quantity.StatusRampEta, Quantity.StatusRampProgress):
+            ramp_eta_s, ramp_progress_percent = self.published_ramp_eta
+            if quantity is Quantity.StatusRampEta:
+                return ramp_eta_s
+            return ramp_progress_percent
 
         raise Exception(f"get_quantity(): Unknown quantity '{quantity.name}'")
 
@@ -672,6 +2132,17 @@ class VisaStation:
             Quantity.StatusMagnetStateZ: self.visa_magnet_z,
         }
 
+    @property
+    def quantity_visa_latency_ms(self):
+        return {
+            Quantity.StatusVisaLatencyP50X: (self.visa_magnet_x, 50.0),
+            Quantity.StatusVisaLatencyP50Y: (self.visa_magnet_y, 50.0),
+            Quantity.StatusVisaLatencyP50Z: (self.visa_magnet_z, 50.0),
+            Quantity.StatusVisaLatencyP99X: (self.visa_magnet_x, 99.0),
+            Quantity.StatusVisaLatencyP99Y: (self.visa_magnet_y, 99.0),
+            Quantity.StatusVisaLatencyP99Z: (self.visa_magnet_z, 99.0),
+        }
+
     @property
     def quantity_magnet_field_actual(self):
         return {
@@ -681,12 +2152,146 @@ class VisaStation:
         }
 
 
+KEEPALIVE_INTERVAL_S = 20.0
+RECONNECT_BACKOFF_MIN_S = 1.0
+RECONNECT_BACKOFF_MAX_S = 60.0
+RECONNECT_STABLE_S = 30.0
+"The backoff is reset by the first I/O after the reconnected connection lasted this long"
+
+_QUERIES_CHANGED_BY_WRITE = {
+    # Command verb: Queries which may return something else after the write
+    "RAMP": ("STATE?",),
+    "PAUSE": ("STATE?",),
+    "ZERO": ("STATE?",),
+    "PS": ("STATE?", "PS?"),
+}
+
+
+_scope_owner = threading.local()
+"Set in the workers of 'VisaStation.for_each_magnet()'"
+
+
+def scope_owner() -> int:
+    """
+    The thread a tick scope belongs to, see 'VisaMagnet.begin_tick()'.
+    The workers of 'VisaStation.for_each_magnet()' act for their caller.
+    """
+    return getattr(_scope_owner, "ident", threading.get_ident())
+
+
+def _io_locked(func):
+    """
+    Serializes the access to the socket of one VisaMagnet.
+    """
+
+    def wrapper(self: "VisaMagnet", *args, **kwargs):
+        with self._io_lock:
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _format_conf_arg(arg: float) -> str:
+    if isinstance(arg, float):
+        return f"{arg:f}"
+    return str(arg)
+
+
+class ShadowRegisters:
+    """
+    Last known values of the configuration registers of one supply.
+    The key is the query to read back the register, for example 'COIL?'.
+
+    The shadow is filled by reading back the registers once and updated by every CONF write.
+    It has to be invalidated whenever the values may have changed behind our back:
+    On reconnect and on errors.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Sequence[float]] = {}
+
+    @staticmethod
+    def parse(response: str) -> Optional[Sequence[float]]:
+        try:
+            return tuple(float(v) for v in response.split(","))
+        except ValueError:
+            return None
+
+    def matches(self, readback: str, values: Sequence[float]) -> bool:
+        shadow_values = self._values.get(readback, None)
+        if shadow_values is None:
+            return False
+        if len(shadow_values) != len(values):
+            return False
+        return all(
+            math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-9)
+            for a, b in zip(shadow_values, values)
+        )
+
+    def update(self, readback: str, values: Optional[Sequence[float]]) -> None:
+        if values is None:
+            self._values.pop(readback, None)
+            return
+        self._values[readback] = tuple(values)
+
+    def invalidate(self) -> None:
+        self._values.clear()
+
+    @property
+    def empty(self) -> bool:
+        return len(self._values) == 0
+
+
+class ResourceManagerPool:
+    """
+    One 'pyvisa.ResourceManager' per visalib, shared by all VisaMagnets
+    and VisaStations in this process.
+
+    Resources are opened directly by address: No 'list_resources()' which
+    would scan the bus/network.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resource_managers: Dict[str, pyvisa.ResourceManager] = {}
+
+    def get(self, visalib: str) -> pyvisa.ResourceManager:
+        with self._lock:
+            resource_manager = self._resource_managers.get(visalib, None)
+            if resource_manager is None:
+                start_s = time.time()
+                resource_manager = pyvisa.ResourceManager(visalib)
+                logger.debug(
+                    f"ResourceManager('{visalib}') created in {time.time()-start_s:0.3f}s"
+                )
+                self._resource_managers[visalib] = resource_manager
+            return resource_manager
+
+    def open_resource(
+        self, visalib: str, address: str
+    ) -> pyvisa.resources.MessageBasedResource:
+        resource_manager = self.get(visalib)
+        start_s = time.time()
+        visa_handle = resource_manager.open_resource(
+            address, read_termination=_VISA_TERMINATOR
+        )
+        logger.info(
+            f"{LoggerTags.VISA_OPEN_DURATION_S.name} {address} {time.time()-start_s:0.3f}"
+        )
+        return visa_handle
+
+
+RESOURCE_MANAGER_POOL = ResourceManagerPool()
+
+
 class VisaMagnet:
     def __init__(self, visa_station: VisaStation, magnet: Magnet, name: str):
         self.visa_station = visa_station
         self.magnet = magnet
         self.name = name
-        self.visa_handle: pyvisa.resources.MessageBasedResource = None
+        self.visa_handle: Union[
+            pyvisa.resources.MessageBasedResource, AMI430SocketResource
+        ] = None
 
         self.field_actual_Tesla: float = None
         "This is the field which is currently set"
@@ -694,6 +2299,26 @@ class VisaMagnet:
         "This field should be set when calling ramp"
         self.field_ramp_TeslaPers: float = 0.0
 
+        self._io_lock = threading.RLock()
+        "One lock per socket. Held during every exchange with the supply."
+        self.shadow_registers = ShadowRegisters()
+        "Skip CONF writes if the register already holds the value"
+
+        self._tick_caches: Dict[int, Dict[str, str]] = {}
+        "'scope_owner()' -> query -> response. Only between 'begin_tick()' and 'end_tick()'"
+        self._recent_snapshot: Optional[MagnetSnapshot] = None
+        "See 'recent_snapshot()'"
+        self._tick_depths: Dict[int, int] = {}
+        self.queries_avoided = 0
+        "Number of queries answered from the tick cache"
+
+        self._last_io_s = time.time()
+        self._reconnect_at_s: Optional[float] = None
+        "None: Connected or closed on purpose. Otherwise: Time of the next reconnect attempt"
+        self._reconnect_backoff_s = RECONNECT_BACKOFF_MIN_S
+        self._reconnected_s: Optional[float] = None
+        "When the last reconnect succeeded. None: Stable, the backoff is reset"
+
         magnet.consistency_check()
 
     @property
@@ -717,12 +2342,69 @@ class VisaMagnet:
         # return "@ivi"
         return "@py"
 
+    def field_unchanged(self, target_T: float, snapshot: MagnetSnapshot) -> bool:
+        """
+        True if 'target_T' is the last target reached and the field is still there.
+        The last target is 'field_actual_Tesla', before the first ramp the programmed target.
+        """
+        if abs(target_T - snapshot.field_T) >= FIELD_UNCHANGED_T:
+            return False
+        if self.field_actual_Tesla is None:
+            return self.conf_matches("CONF:FIELD:TARG", target_T)
+        return abs(target_T - self.field_actual_Tesla) < 1e-12
+
+    def expected_ramp_duration_s(
+        self,
+        start_T: float,
+        target_T: float,
+        rate_Tpers: float,
+        segments_Tpers: Optional[Sequence[Tuple[float, float]]] = None,
+    ) -> float:
+        """
+        Field ramp without overhead: Through 'segments_Tpers' if given, else at 'rate_Tpers'.
+        Rate 0 is not a valid ramp rate: Estimated at the maximal rate of the magnet.
+        """
+        if segments_Tpers is not None:
+            return segmented_ramp_duration_s(start_T, target_T, segments_Tpers)
+        if rate_Tpers <= 0.0:
+            rate_Tpers = self.magnet.max_rampr_rate_Tpers
+        return abs(target_T - start_T) / rate_Tpers
+
     @property
-    def expected_ramp_duration_s(self) -> float:
-        try:
-            return self.field_setpoint_Tesla / self.field_ramp_TeslaPers
-        except (ZeroDivisionError, DivisionByZero):
-            return 2 * 60 * 60
+    def ramp_segments_Tpers(self) -> Optional[List[Tuple[float, float]]]:
+        """
+        The ramp rate table for a ramp which is not a vector ramp:
+        'Magnet.ramp_rate_segments_Tpers' capped by 'Control / Ramp Rate' if set.
+        None: No table configured.
+        """
+        segments_Tpers = self.magnet.ramp_rate_segments_Tpers
+        if segments_Tpers is None:
+            return None
+        if self.field_ramp_TeslaPers <= 0.0:
+            return list(segments_Tpers)
+        return [
+            (upper_T, min(rate_Tpers, self.field_ramp_TeslaPers))
+            for upper_T, rate_Tpers in segments_Tpers
+        ]
+
+    @staticmethod
+    def ramp_rate_confs(
+        rate_Tpers: float,
+        segments_Tpers: Optional[Sequence[Tuple[float, float]]] = None,
+    ) -> List[Tuple]:
+        """
+        The CONF commands programming the ramp rate table of the supply:
+        'segments_Tpers' or a single segment at 'rate_Tpers'.
+        """
+        if segments_Tpers is None:
+            return [
+                ("CONF:RAMP:RATE:SEG", 1),
+                ("CONF:RAMP:RATE:FIELD", 1, rate_Tpers, 0),
+            ]
+        confs: List[Tuple] = [("CONF:RAMP:RATE:SEG", len(segments_Tpers))]
+        for segment, (upper_T, segment_rate_Tpers) in enumerate(segments_Tpers, 1):
+            confs.append(("CONF:RAMP:RATE:FIELD", segment, segment_rate_Tpers, upper_T))
+        return confs
 
     @property
     def switchheater_state(self) -> int:
@@ -735,25 +2417,159 @@ class VisaMagnet:
 
     # self.write_raw(f"PS {SwitchHeaterState[state].value}")
 
-    def open(self) -> None:
-        resource_manager = pyvisa.ResourceManager(self.visalib)
-        resources = resource_manager.list_resources()
-
-        self.visa_handle = resource_manager.open_resource(
-            self.magnet.ip_address, read_termination="\n"
-        )
-        assert isinstance(self.visa_handle, pyvisa.resources.MessageBasedResource)
+    @property
+    def use_asyncio_socket(self) -> bool:
+        if self.use_visa_simulation:
+            return False
+        if not self.visa_station.station.use_asyncio_socket:
+            return False
+        return parse_socket_address(self.magnet.ip_address) is not None
+
+    def _open_handle(self) -> None:
+        self.shadow_registers.invalidate()
+        if self.visa_station.replay_session is not None:
+            visa_handle = ScpiReplayResource(
+                session=self.visa_station.replay_session, axis=self.name
+            )
+        elif self.use_asyncio_socket:
+            start_s = time.time()
+            visa_handle = AMI430SocketResource(address=self.magnet.ip_address)
+            visa_handle.open()
+            logger.info(
+                f"{LoggerTags.VISA_OPEN_DURATION_S.name} {self.magnet.ip_address} {time.time()-start_s:0.3f}"
+            )
+        else:
+            visa_handle = RESOURCE_MANAGER_POOL.open_resource(
+                visalib=self.visalib, address=self.magnet.ip_address
+            )
+            assert isinstance(visa_handle, pyvisa.resources.MessageBasedResource)
+        self.visa_handle = visa_handle
+        self._last_io_s = time.time()
 
+    @_io_locked
+    def open(self) -> None:
+        self._open_handle()
         self._visa_clear()
         self._visa_init()
+        self._reconnect_at_s = None
+        self._reconnect_backoff_s = RECONNECT_BACKOFF_MIN_S
+        self._reconnected_s = None
 
     def prefix(self, msg) -> str:
         return f"{self.name}: {msg}"
 
+    @_io_locked
     def close(self) -> None:
-        if self.visa_handle is not None:
-            self.visa_handle.close()
-            self.visa_handle = None
+        self._reconnect_at_s = None
+        self._close_handle()
+
+    def _close_handle(self) -> None:
+        self.shadow_registers.invalidate()
+        for tick_cache in self._tick_caches.values():
+            tick_cache.clear()
+        visa_handle, self.visa_handle = self.visa_handle, None
+        if visa_handle is not None:
+            try:
+                visa_handle.close()
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.debug(self.prefix(f"close(): {ex!r}"))
+
+    @property
+    def connected(self) -> bool:
+        return self.visa_handle is not None
+
+    def _connection_lost(self, ex: Exception) -> None:
+        if self._reconnected_s is not None:
+            # Lost again before it was stable: A flapping connection backs off too
+            self._reconnected_s = None
+            self._reconnect_backoff_s = min(
+                2.0 * self._reconnect_backoff_s, RECONNECT_BACKOFF_MAX_S
+            )
+        logger.warning(
+            self.prefix(
+                f"Connection lost ({ex!r}). Reconnect in {self._reconnect_backoff_s:0.1f}s"
+            )
+        )
+        self._close_handle()
+        self._reconnect_at_s = time.time() + self._reconnect_backoff_s
+
+    @_io_locked
+    def maintain_connection(self) -> None:
+        """
+        Called periodically by the visa thread.
+        Reconnects a lost connection using a bounded exponential backoff
+        and sends keepalives on an idle connection.
+        """
+        if self._reconnect_at_s is not None:
+            if time.time() < self._reconnect_at_s:
+                return
+            try:
+                self._reconnect()
+            except Exception as ex:  # pylint: disable=broad-except
+                self._close_handle()
+                self._reconnect_backoff_s = min(
+                    2.0 * self._reconnect_backoff_s, RECONNECT_BACKOFF_MAX_S
+                )
+                self._reconnect_at_s = time.time() + self._reconnect_backoff_s
+                logger.warning(
+                    self.prefix(
+                        f"Reconnect failed ({ex!r}). Retry in {self._reconnect_backoff_s:0.1f}s"
+                    )
+                )
+            return
+
+        if not self.connected:
+            # Closed on purpose
+            return
+
+        if time.time() - self._last_io_s > KEEPALIVE_INTERVAL_S:
+            self.ask_raw("STATE?")
+
+    def _reconnect(self) -> None:
+        """
+        The supply continues on its own while the connection is down.
+        Therefore we do not configure it again: Changing the ramp rate or target
+        would disturb a ramp in progress. We only read back the registers.
+        """
+        self._open_handle()
+        self._visa_clear()
+        self.read_shadow_registers()
+        self._reconnect_at_s = None
+        # The backoff is reset once the connection proved stable, see '_visa_io()'
+        self._reconnected_s = time.time()
+        logger.info(self.prefix("Reconnected"))
+
+    @contextlib.contextmanager
+    def _visa_io(self, verb: str):
+        """
+        Wraps every access to the visa_handle: Detects dead connections
+        and records the latency per command verb.
+        """
+        if self.visa_handle is None:
+            raise VisaMagnetException(
+                magnet_name=self.name, msg="Not connected, reconnect pending"
+            )
+        start_s = time.time()
+        try:
+            yield
+        except (pyvisa.VisaIOError, OSError) as ex:
+            self._connection_lost(ex)
+            raise VisaMagnetException(
+                magnet_name=self.name, msg=f"Connection lost: {ex!r}"
+            ) from ex
+        except:  # pylint: disable=bare-except
+            self.shadow_registers.invalidate()
+            raise
+        self._last_io_s = time.time()
+        self.visa_station.metrics.record(
+            axis=self.name, verb=verb, duration_s=self._last_io_s - start_s
+        )
+        if (
+            self._reconnected_s is not None
+            and self._last_io_s - self._reconnected_s > RECONNECT_STABLE_S
+        ):
+            self._reconnected_s = None
+            self._reconnect_backoff_s = RECONNECT_BACKOFF_MIN_S
 
     def _visa_clear(self) -> None:
         self.visa_handle.write_termination = _VISA_TERMINATOR
@@ -791,29 +2607,76 @@ class VisaMagnet:
 
         idn = self.ask_raw("*IDN?")
 
+        self.read_shadow_registers()
+
         # Choose field units in Tesla and ramp units in seconds
-        self.write_raw("CONF:FIELD:UNITS 1")
-        self.write_raw("CONF:RAMP:RATE:UNITS 0")
-        self.write_raw(f"CONF:COIL {self.magnet.coil_constant_TperA:f}")
-        self.write_raw(f"CONF:CURR:LIMIT {self.magnet.current_limit_A:f}")
-        self.write_raw(f"CONF:IND {self.magnet.inductance_H:f}")
-        self.write_raw(f"CONF:STAB {self.magnet.stability_parameter:f}")
-        # TODO(benedikt)
-        self.write_raw("CONF:RAMP:RATE:SEG 1")
-        self.write_raw("CONF:RAMP:RATE:FIELD 1,0.001,0")
+        self.write_conf("CONF:FIELD:UNITS", 1)
+        self.write_conf("CONF:RAMP:RATE:UNITS", 0)
+        self.write_conf("CONF:COIL", self.magnet.coil_constant_TperA)
+        self.write_conf("CONF:CURR:LIMIT", self.magnet.current_limit_A)
+        self.write_conf("CONF:IND", self.magnet.inductance_H)
+        self.write_conf("CONF:STAB", self.magnet.stability_parameter)
+        # Programmed once: The ramps skip the writes while the shadow registers match
+        for conf in self.ramp_rate_confs(
+            rate_Tpers=0.001, segments_Tpers=self.ramp_segments_Tpers
+        ):
+            self.write_conf(*conf)
         if self.magnet.has_switchheater:
-            self.write_raw("CONF:PS 1")
-            self.write_raw(f"CONF:PS:HTIME {self.magnet.switchheater_heat_time_s:f}")
-            self.write_raw(f"CONF:PS:CTIME {self.magnet.switchheater_cool_time_s:f}")
+            self.write_conf("CONF:PS", 1)
+            self.write_conf("CONF:PS:HTIME", self.magnet.switchheater_heat_time_s)
+            self.write_conf("CONF:PS:CTIME", self.magnet.switchheater_cool_time_s)
             # Datasheet ...: mA
-            self.write_raw(
-                f"CONF:PS:CURR {self.magnet.switchheater_current_A*1000.0:f}"
-            )
-            self.write_raw(
-                f"CONF:PS:PSRR {self.magnet.persisten_current_rampe_rate_Apers:f}"
+            self.write_conf("CONF:PS:CURR", self.magnet.switchheater_current_A * 1000.0)
+            self.write_conf(
+                "CONF:PS:PSRR", self.magnet.persisten_current_rampe_rate_Apers
             )
         else:
-            self.write_raw("CONF:PS 0")
+            self.write_conf("CONF:PS", 0)
+
+    def read_shadow_registers(self) -> None:
+        """
+        Read back all configuration registers in one pipelined exchange.
+        """
+        readbacks = [readback.format(1) for readback, _ in _CONF_READBACK.values()]
+        if self.magnet.ramp_rate_segments_Tpers is not None:
+            readback, _ = _CONF_READBACK["CONF:RAMP:RATE:FIELD"]
+            readbacks.extend(
+                readback.format(segment)
+                for segment in range(2, len(self.magnet.ramp_rate_segments_Tpers) + 1)
+            )
+        responses = self.ask_pipelined_raw(readbacks, verb="READBACK")
+        for readback, response in zip(readbacks, responses):
+            self.shadow_registers.update(readback, ShadowRegisters.parse(response))
+
+    @staticmethod
+    def _conf_readback(cmd: str, args: Sequence[float]):
+        """
+        Returns the readback query and the values as the instrument will store them:
+        Formatted like we send them.
+        """
+        readback, index_args = _CONF_READBACK[cmd]
+        values = [float(_format_conf_arg(arg)) for arg in args[index_args:]]
+        return readback.format(*args[:index_args]), values
+
+    def conf_matches(self, cmd: str, *args) -> bool:
+        """
+        True if the shadow register already holds the value: A write may be skipped.
+        """
+        readback, values = self._conf_readback(cmd, args)
+        return self.shadow_registers.matches(readback, values)
+
+    def write_conf(self, cmd: str, *args) -> None:
+        """
+        Example: write_conf("CONF:RAMP:RATE:FIELD", 1, 0.01, 0)
+        The write is skipped if the shadow register already holds the value.
+        """
+        if self.conf_matches(cmd, *args):
+            logger.debug(self.prefix(f"Skipped: {cmd} {args}"))
+            return
+        text_args = ",".join(_format_conf_arg(arg) for arg in args)
+        self.write_raw(f"{cmd} {text_args}")
+        readback, values = self._conf_readback(cmd, args)
+        self.shadow_registers.update(readback, values)
 
     def wait_for_state(
         self,
@@ -828,13 +2691,46 @@ class VisaMagnet:
 
             time.sleep(sleep_s)
             visa_state = self.visa_state
-            if self.visa_state != transition_state:
+            if visa_state != transition_state:
                 break
             duration_s = time.time() - begin_s
             msg = f"Timeout after waiting for {max_timeout_s}s for {final_state.name}. Current state {visa_state.name}"
             if duration_s > max_timeout_s:
                 raise Exception(msg)
-        assert self.visa_state == final_state
+        assert visa_state == final_state
+
+    def snapshot(self) -> MagnetSnapshot:
+        """
+        Query STATE?, FIELD:MAG?, PS?, CURR:MAG? and QU? in one pipelined exchange.
+        """
+        state, field_T, switchheater_state, current_magnet_A, quench_state = (
+            self.ask_pipelined_raw(_SNAPSHOT_QUERIES, verb="SNAPSHOT")
+        )
+        snapshot = MagnetSnapshot(
+            name=self.name,
+            time_s=time.time(),
+            state=AMI430State.from_visa(state),
+            field_T=float(field_T),
+            switchheater_state=int(switchheater_state),
+            current_magnet_A=float(current_magnet_A),
+            quench_state=int(quench_state),
+        )
+        logger.info(
+            f"{LoggerTags.MAGNET_STATE.name} {self.name} {snapshot.state.name} {snapshot.state.value}"
+        )
+        logger.info(f"{LoggerTags.MAGNET_FIELD.name} {self.name} {snapshot.field_T}")
+        self._recent_snapshot = snapshot
+        return snapshot
+
+    def recent_snapshot(self, max_age_s: float) -> MagnetSnapshot:
+        """
+        The last snapshot if it is younger than 'max_age_s' and no write changed it since.
+        Else a new snapshot.
+        """
+        snapshot = self._recent_snapshot
+        if snapshot is not None and snapshot.age_s <= max_age_s:
+            return snapshot
+        return self.snapshot()
 
     @property
     def visa_field_T(self) -> float:
@@ -863,6 +2759,55 @@ class VisaMagnet:
         # TODO: What will be returned?
         return self.ask_raw("SYST:ERR?", astype=int)
 
+    @_io_locked
+    def begin_tick(self) -> None:
+        """
+        Within a tick, every query is sent at most once.
+        Writes invalidate the affected responses.
+        Every thread has its own tick: The labber thread does not see the responses
+        cached by the visa thread.
+        """
+        owner = scope_owner()
+        self._tick_depths[owner] = self._tick_depths.get(owner, 0) + 1
+        self._tick_caches.setdefault(owner, {})
+
+    @_io_locked
+    def end_tick(self) -> None:
+        owner = scope_owner()
+        assert self._tick_depths.get(owner, 0) > 0
+        self._tick_depths[owner] -= 1
+        if self._tick_depths[owner] == 0:
+            del self._tick_depths[owner]
+            del self._tick_caches[owner]
+
+    @staticmethod
+    def _queries_changed_by(cmd: str) -> Optional[Sequence[str]]:
+        "The queries which may return something else after writing 'cmd'. None: All."
+        verb = cmd.split(" ", 1)[0]
+        queries = _QUERIES_CHANGED_BY_WRITE.get(verb, None)
+        if queries is not None:
+            return queries
+        readback = _CONF_READBACK.get(verb, None)
+        if readback is None:
+            # Unknown command
+            return None
+        query, index_args = readback
+        if index_args > 0:
+            return None
+        return (query,)
+
+    def _invalidate_tick_cache(self, cmd: str) -> None:
+        queries = self._queries_changed_by(cmd)
+        if queries is None or not set(queries).isdisjoint(_SNAPSHOT_QUERIES):
+            self._recent_snapshot = None
+        for tick_cache in self._tick_caches.values():
+            if queries is None:
+                tick_cache.clear()
+                continue
+            for query in queries:
+                tick_cache.pop(query, None)
+
+    @_io_locked
     def write_raw(self, cmd: str) -> None:
         """
         Low-level interface to ``visa_handle.write``.
@@ -871,7 +2816,14 @@ class VisaMagnet:
             cmd: The command to send to the instrument.
         """
         logger.debug(self.prefix(f"Writing: {cmd}"))
-        self.visa_handle.write(cmd)
+        self._invalidate_tick_cache(cmd)
+        start_s = time.time()
+        with self._visa_io(verb=command_verb(cmd)):
+            self.visa_handle.write(cmd)
+        if self.visa_station.recorder is not None:
+            self.visa_station.recorder.write(
+                axis=self.name, cmd=cmd, duration_s=time.time() - start_s
+            )
 
     def ask_raw(self, cmd: str, astype=None) -> Any:
         response = self._ask_raw(cmd=cmd, astype=astype)
@@ -889,7 +2841,7 @@ class VisaMagnet:
             The instrument's response.
         """
         # logger.debug(self.prefix(f"Querying: {cmd}"))
-        response = self.visa_handle.query(cmd)
+        (response,) = self.ask_pipelined_raw((cmd,))
         if astype is None:
             # logger.debug(self.prefix(f"Response: '{response}'"))
             return response
@@ -900,6 +2852,51 @@ class VisaMagnet:
         # logger.debug(self.prefix(f"Response: {repr(response_type)}"))
         return response_type
 
+    @_io_locked
+    def ask_pipelined_raw(
+        self, cmds: Sequence[str], verb: Optional[str] = None
+    ) -> List[str]:
+        """
+        Send all queries before reading the first response.
+        This costs one round-trip instead of one per query.
+        'verb': Name of the exchange in the latency metrics.
+        """
+        tick_cache = self._tick_caches.get(scope_owner(), None)
+        if tick_cache is None:
+            return self._ask_pipelined_raw(cmds, verb=verb)
+
+        cmds_missing = [cmd for cmd in cmds if cmd not in tick_cache]
+        self.queries_avoided += len(cmds) - len(cmds_missing)
+        if len(cmds_missing) > 0:
+            responses = self._ask_pipelined_raw(cmds_missing, verb=verb)
+            tick_cache.update(zip(cmds_missing, responses))
+        return [tick_cache[cmd] for cmd in cmds]
+
+    def _ask_pipelined_raw(
+        self, cmds: Sequence[str], verb: Optional[str] = None
+    ) -> List[str]:
+        if verb is None:
+            verb = ";".join(command_verb(cmd) for cmd in cmds)
+        start_s = time.time()
+        with self._visa_io(verb=verb):
+            if len(cmds) == 1:
+                responses = [self.visa_handle.query(cmds[0])]
+            elif isinstance(self.visa_handle, AMI430SocketResource):
+                responses = self.visa_handle.query_pipelined(cmds)
+            else:
+                for cmd in cmds:
+                    self.visa_handle.write(cmd)
+                responses = [self.visa_handle.read() for _ in cmds]
+        if self.visa_station.recorder is not None:
+            self.visa_station.recorder.queries(
+                axis=self.name,
+                cmds=cmds,
+                responses=responses,
+                duration_s=time.time() - start_s,
+            )
+        logger.debug(self.prefix(f"ask_pipelined_raw: {cmds!r} -> {responses!r}"))
+        return responses
+
     def debug(self, msg: str) -> None:
         self.visa_log.debug(f"{self.name} {msg}")
 